@@ -0,0 +1,156 @@
+"""
+Analysis of till differences, to spot closures which are out of line with
+the outlet's or staff member's recent history.
+
+Needs NumPy, which is optional (`pip install cashup[analytics]`); without it
+`closure_anomalies` returns None and the list pages leave the analysis out.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .models import TillClosure
+from .utils import cache_version, bump_cache_version
+
+
+def closure_history_version(group_field, pk):
+    return cache_version('cashup:closure-history', group_field, pk)
+
+def invalidate_closure_history(outlets=(), personnel=()):
+    """
+    Invalidates the cached analysis of the closures of the Outlets and
+    Personnel with the given pks.
+    """
+    for pk in set(outlets):
+        bump_cache_version('cashup:closure-history', 'outlet', pk)
+    for pk in set(personnel):
+        bump_cache_version('cashup:closure-history', 'closed_by', pk)
+
+
+def _window_stats(sums, squares, lo, hi):
+    """
+    Returns the mean and sample standard deviation of each window of values
+    [lo, hi), given the cumulative sums of the values and their squares.
+    Windows of fewer than two values get NaN.
+    """
+    count = hi - lo
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (sums[hi] - sums[lo]) / count
+        var = (squares[hi] - squares[lo] - count * mean ** 2) / (count - 1)
+        var[count < 2] = np.nan
+    return mean, np.sqrt(np.maximum(var, 0))
+
+def rolling_zscores(groups, values, window=30, min_periods=5, min_std=1.0):
+    """
+    Takes arrays of group keys and values in time order and returns arrays
+    of the mean and standard deviation of the `window` values before each
+    one in the same group, and its z-score against them.
+    Values with fewer than `min_periods` before them get NaN. The standard
+    deviation used for z-scores is at least `min_std`, so a group whose
+    history is all the same doesn't make every small change an outlier.
+    """
+    n = len(values)
+    # stable, so each group stays in time order
+    order = np.argsort(groups, kind='mergesort')
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    index = np.arange(n)
+    starts = np.ones(n, dtype=bool)
+    starts[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    first = np.maximum.accumulate(np.where(starts, index, 0))
+    lo = np.maximum(first, index - window)
+    sums = np.concatenate(([0], np.cumsum(sorted_values)))
+    squares = np.concatenate(([0], np.cumsum(sorted_values ** 2)))
+    mean, std = _window_stats(sums, squares, lo, index)
+    z = (sorted_values - mean) / np.maximum(std, min_std)
+    too_few = index - lo < min_periods
+    mean[too_few] = std[too_few] = z[too_few] = np.nan
+
+    result = np.empty((3, n))
+    result[:, order] = mean, std, z
+    return result
+
+def till_difference_anomalies(queryset, group_field, window=None,
+                              threshold=None):
+    """
+    Analyses the till differences of the TillClosures in `queryset` grouped
+    by `group_field` ('outlet' or 'closed_by'), with one query and no Python
+    loop over closures, so a million closures take a few seconds.
+    Returns a dict mapping each group's pk to a dict of its number of
+    `closures`, the `mean` and `std` of its last `window` differences, and
+    `outliers`, a dict mapping the identity of each closure whose z-score
+    against the ones before it exceeds `threshold` to that z-score.
+    """
+    if window is None:
+        window = getattr(settings, 'CASHUP_ANOMALY_WINDOW', 30)
+    if threshold is None:
+        threshold = getattr(settings, 'CASHUP_ANOMALY_THRESHOLD', 3.0)
+    # cast in the database and read with a plain cursor, as making Decimals
+    # and running the ORM's per row conversions take longer than the query
+    queryset = queryset.annotate(
+        difference=Cast('till_difference', FloatField()),
+    ).order_by('close_time', 'identity').values_list(
+        group_field, 'identity', 'difference')
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return {}
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    if not rows:
+        return {}
+    data = np.array(rows, dtype=float)
+    groups = data[:, 0].astype(np.int64)
+    identities = data[:, 1].astype(np.int64)
+    values = data[:, 2]
+    mean, std, z = rolling_zscores(groups, values, window)
+    with np.errstate(invalid='ignore'):
+        flagged = np.flatnonzero(np.abs(z) > threshold)
+
+    # each group's latest window, from the values sorted by group
+    keys, counts = np.unique(groups, return_counts=True)
+    ends = np.cumsum(counts)
+    order = np.argsort(groups, kind='mergesort')
+    sums = np.concatenate(([0], np.cumsum(values[order])))
+    squares = np.concatenate(([0], np.cumsum(values[order] ** 2)))
+    latest_mean, latest_std = _window_stats(
+        sums, squares, np.maximum(ends - counts, ends - window), ends)
+
+    results = {}
+    for key, count, group_mean, group_std in zip(
+            keys.tolist(), counts.tolist(), latest_mean.tolist(),
+            latest_std.tolist()):
+        results[key] = {'closures': count, 'mean': group_mean,
+                        'std': None if np.isnan(group_std) else group_std,
+                        'outliers': {}}
+    for i in flagged.tolist():
+        results[int(groups[i])]['outliers'][int(identities[i])] = float(z[i])
+    return results
+
+def closure_anomalies(group_field, pk):
+    """
+    Returns `till_difference_anomalies` for the current TillClosures of the
+    Outlet or Personnel `pk`, or None without NumPy. Results are cached
+    until one of its TillClosures is next created, changed or deleted.
+    """
+    if np is None:
+        return None
+    key = 'cashup:closure-anomalies:{}:{}:{}'.format(
+        group_field, pk, closure_history_version(group_field, pk))
+    anomalies = cache.get(key)
+    if anomalies is None:
+        anomalies = till_difference_anomalies(
+            TillClosure.objects.filter(**{group_field: pk}),
+            group_field).get(pk, {})
+        timeout = getattr(settings, 'CASHUP_ANOMALY_TIMEOUT', 86400)
+        cache.set(key, anomalies, timeout)
+    return anomalies
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CashupConfig(AppConfig):
     name = 'cashup'
+
+    def ready(self):
+        from . import signals  # noqa
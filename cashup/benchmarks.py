@@ -0,0 +1,336 @@
+"""
+Benchmarks run by the `cashup_benchmark` management command.
+
+Each benchmark seeds its own data inside a transaction which is rolled back
+once it has finished, so they can safely be pointed at a development
+database. Benchmarks may return a dict of results to be saved as JSON and
+compared against an earlier run with `find_regressions`.
+"""
+import datetime
+import operator
+import timeit
+import tracemalloc
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, reset_queries
+from django.db.models import Q, F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import urls
+from .models import (Business, Outlet, Personnel, StaffPosition, TillClosure,
+                     DENOMINATION_FIELDS)
+
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def best_of(func, repeat, number=1):
+    """Returns the fastest time in seconds for a single call of func."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def percentile(values, percent):
+    """Returns the nearest-rank `percent` percentile of values."""
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+# metrics where a higher value is a regression, with whether any increase
+# counts rather than only one beyond the threshold
+REGRESSION_METRICS = {'queries': True, 'p50_ms': False, 'p95_ms': False,
+                      'peak_kb': False}
+
+def find_regressions(results, baseline, threshold, path=()):
+    """
+    Compares nested benchmark results against a baseline from an earlier
+    run. Returns a description of each metric which has grown, by more than
+    `threshold` (a fraction) for timings and memory or at all for queries.
+    """
+    regressions = []
+    for key, value in results.items():
+        previous = baseline.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            regressions.extend(find_regressions(
+                value, previous, threshold, path + (key,)))
+        elif key in REGRESSION_METRICS and previous is not None:
+            limit = previous if REGRESSION_METRICS[key] else \
+                previous * (1 + threshold)
+            if value > limit:
+                regressions.append('{}: {} -> {}'.format(
+                    '.'.join(path + (key,)), previous, value))
+    return regressions
+
+
+def seed_business(name='Benchmark', outlets=300, personnel=2000,
+                  positions_per_personnel=2):
+    """
+    Creates a Business with an owner, `outlets` Outlets and `personnel`
+    Personnel, each staff of `positions_per_personnel` Outlets (the first of
+    which they manage for every tenth Personnel).
+    """
+    User = get_user_model()
+    business = Business.objects.create(name=name)
+    prefix = 'bench-{}-'.format(business.pk)
+
+    User.objects.bulk_create([
+        User(username='{}{}'.format(prefix, i), password='!')
+        for i in range(personnel + 1)])
+    users = list(User.objects.filter(
+        username__startswith=prefix).order_by('pk'))
+    Personnel.objects.bulk_create([
+        Personnel(user=user, business=business, is_owner=(i == 0))
+        for i, user in enumerate(users)])
+    Outlet.objects.bulk_create([
+        Outlet(business=business, name='Outlet {}'.format(i),
+               slug='Outlet-{}'.format(i), default_float=Decimal('100.00'))
+        for i in range(outlets)])
+
+    staff = list(Personnel.objects.filter(
+        business=business, is_owner=False).order_by('pk'))
+    outlet_pks = list(Outlet.objects.filter(
+        business=business).order_by('pk').values_list('pk', flat=True))
+    StaffPosition.objects.bulk_create([
+        StaffPosition(personnel=person,
+                      outlet_id=outlet_pks[(i + j) % len(outlet_pks)],
+                      is_manager=(j == 0 and i % 10 == 0), is_staff=True)
+        for i, person in enumerate(staff)
+        for j in range(positions_per_personnel)])
+    return business
+
+
+def legacy_for_personnel(queryset, personnel, is_manager=False):
+    """The join based OutletQuerySet.for_personnel, kept for comparison."""
+    filters = [
+        Q(business__personnel=personnel) &
+            Q(business__personnel__is_owner=True),
+        Q(staff__is_manager=True) & Q(staff__personnel=personnel)
+    ]
+    if not is_manager:
+        filters.append(
+            Q(staff__is_staff=True) & Q(staff__personnel=personnel))
+    q_obj = reduce(operator.or_, filters)
+    return queryset.filter(q_obj).distinct().order_by('name')
+
+
+@benchmark('for_personnel')
+def for_personnel(stdout, options):
+    """OutletQuerySet.for_personnel against the join based version."""
+    repeat = options['repeat']
+    business = seed_business()
+    personnel = Personnel.objects.filter(business=business)
+    cases = [
+        ('owner', personnel.get(is_owner=True), False),
+        ('manager', personnel.filter(
+            positions__is_manager=True).first(), True),
+        ('staff', personnel.filter(
+            is_owner=False, positions__is_manager=False).last(), False),
+    ]
+    for label, person, is_manager in cases:
+        legacy = lambda: list(legacy_for_personnel(
+            Outlet.objects.all(), person, is_manager))
+        current = lambda: list(
+            Outlet.objects.for_personnel(person, is_manager))
+        assert [o.pk for o in legacy()] == [o.pk for o in current()]
+        legacy_time = best_of(legacy, repeat)
+        current_time = best_of(current, repeat)
+        stdout.write('{:<8} joins: {:8.2f}ms  exists: {:8.2f}ms  '
+                     '({:.1f}x)'.format(
+                        label, legacy_time * 1000, current_time * 1000,
+                        legacy_time / current_time))
+
+
+def legacy_total(tillclosure):
+    """The float based TillClosure.total, kept for comparison."""
+    return sum([Decimal(d.count * d.pence_value * 0.01)
+                for d in (getattr(tillclosure, f.attname)
+                          for f in DENOMINATION_FIELDS)])
+
+
+@benchmark('total')
+def total(stdout, options):
+    """TillClosure.total against the float based version."""
+    repeat = options['repeat']
+    tillclosure = TillClosure()
+    for i, field in enumerate(DENOMINATION_FIELDS):
+        setattr(tillclosure, field.attname, field.to_python(i * 7 + 3))
+    assert tillclosure.total() == legacy_total(tillclosure).quantize(
+        Decimal('0.01'))
+    number = 10000
+    legacy_time = best_of(lambda: legacy_total(tillclosure), repeat, number)
+    current_time = best_of(tillclosure.total, repeat, number)
+    stdout.write('float: {:6.2f}us  pence: {:6.2f}us  ({:.1f}x)'.format(
+        legacy_time * 1e6, current_time * 1e6, legacy_time / current_time))
+
+
+def seed_closures(businesses, closures, versions_every=10, days=365):
+    """
+    Creates `closures` TillClosures spread evenly over the Outlets of
+    `businesses` and the last `days` days, each closed by one of the
+    Outlet's staff. Every `versions_every`th closure is given a superseded
+    first version.
+    """
+    staff = defaultdict(list)
+    for outlet, personnel in StaffPosition.objects.filter(
+            outlet__business__in=businesses).order_by(
+            'outlet', 'personnel').values_list('outlet', 'personnel'):
+        staff[outlet].append(personnel)
+    outlets = sorted(staff)
+    start = timezone.now() - datetime.timedelta(days=days)
+    step = datetime.timedelta(days=days) / max(closures // len(outlets), 1)
+
+    def rows():
+        for n in range(closures):
+            outlet = outlets[n % len(outlets)]
+            closers = staff[outlet]
+            yield {'outlet': outlet,
+                   'closed_by': closers[n // len(outlets) % len(closers)],
+                   'close_time': start + step * (n // len(outlets)),
+                   'cash_takings': Decimal(n % 500) + Decimal('0.50'),
+                   'card_takings': Decimal(n % 300),
+                   'till_float': Decimal('100.00'),
+                   'note_20GBP': n % 25, 'coin_1GBP': n % 40}
+    TillClosure.audit_trail.bulk_import(rows(), batch_size=5000)
+
+    seeded = TillClosure.audit_trail.filter(
+        outlet__business__in=businesses).order_by('pk')
+    edited = [closure for n, closure in enumerate(seeded.iterator())
+              if n % versions_every == 0]
+    now = timezone.now()
+    # bump the current versions first so the copies can take version 1
+    for n in range(0, len(edited), 500):
+        TillClosure.audit_trail.filter(pk__in=[
+            closure.pk for closure in edited[n:n + 500]]).update(
+            version_number=2, version_created_time=now,
+            updated_by=F('closed_by'))
+    for closure in edited:
+        closure.pk = None
+        closure.version_superseded_time = now
+    TillClosure.audit_trail.bulk_create(edited)
+
+
+def url_kwargs(business):
+    """
+    Returns the Personnel to log in as for each role in `business` and the
+    URL kwargs they share: a managed Outlet, one of its staff, and a
+    versioned closure they made there.
+    """
+    position = StaffPosition.objects.filter(
+        outlet__business=business, is_manager=True).select_related(
+        'personnel__user', 'outlet').first()
+    outlet = position.outlet
+    staff = Personnel.objects.filter(
+        positions__outlet=outlet, positions__is_manager=False).select_related(
+        'user').first()
+    closures = TillClosure.objects.filter(outlet=outlet, closed_by=staff)
+    tillclosure = closures.filter(version_number__gt=1).first() or \
+        closures.first()
+    roles = OrderedDict([
+        ('owner', business.personnel.get(is_owner=True)),
+        ('manager', position.personnel),
+        ('staff', staff),
+    ])
+    kwargs = {'slug': outlet.slug, 'username': staff.user.username,
+              'pk': str(tillclosure.pk), 'version': '1'}
+    return roles, kwargs
+
+
+def time_request(client, url, requests):
+    """
+    Returns the status, query count, p50 and p95 latency and peak memory
+    of GET requests to url, after one request to warm any caches. Streamed
+    responses are read to the end, as their queries run while streaming.
+    """
+    def get():
+        response = client.get(url)
+        if response.streaming:
+            for chunk in response.streaming_content:
+                pass
+        return response
+
+    get()
+    # each request resets the query log, so start from an empty one
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        response = get()
+    # counted now, as the next request empties the log the queries are
+    # read from
+    num_queries = len(queries)
+    times = []
+    for i in range(requests):
+        start = timeit.default_timer()
+        get()
+        times.append(timeit.default_timer() - start)
+    tracemalloc.start()
+    try:
+        get()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([
+        ('status', response.status_code),
+        ('queries', num_queries),
+        ('p50_ms', round(percentile(times, 50) * 1000, 2)),
+        ('p95_ms', round(percentile(times, 95) * 1000, 2)),
+        ('peak_kb', round(peak / 1024.0, 1)),
+    ])
+
+
+@benchmark('urls')
+def cashup_urls(stdout, options):
+    """Query counts, latency and memory of every cashup URL by role."""
+    businesses = [
+        seed_business(name='Benchmark {}'.format(i),
+                      outlets=options['outlets'],
+                      personnel=options['personnel'])
+        for i in range(options['businesses'])]
+    seed_closures(businesses, options['closures'])
+    roles, kwargs = url_kwargs(businesses[0])
+
+    results = OrderedDict()
+    client = Client()
+    with override_settings(
+            ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+        for pattern in urls.urlpatterns:
+            url = reverse(pattern.name, kwargs={
+                name: kwargs[name] for name in pattern.regex.groupindex})
+            results[pattern.name] = OrderedDict()
+            for role, personnel in roles.items():
+                client.force_login(personnel.user)
+                result = time_request(client, url, options['requests'])
+                results[pattern.name][role] = result
+                stdout.write('{:<34} {:<8} {status:>3} {queries:>4}q  '
+                             'p50 {p50_ms:8.2f}ms  p95 {p95_ms:8.2f}ms  '
+                             '{peak_kb:9.1f}KB'.format(
+                                pattern.name, role, **result))
+    return results
+
+
+@benchmark('anomalies')
+def anomalies(stdout, options):
+    """Till difference analysis of every closure, by outlet and by staff."""
+    from .analytics import np, till_difference_anomalies
+    if np is None:
+        stdout.write('NumPy is not installed')
+        return
+    businesses = [
+        seed_business(name='Benchmark {}'.format(i),
+                      outlets=options['outlets'],
+                      personnel=options['personnel'])
+        for i in range(options['businesses'])]
+    seed_closures(businesses, options['closures'])
+    closures = TillClosure.objects.count()
+    for group_field in ('outlet', 'closed_by'):
+        seconds = best_of(lambda: till_difference_anomalies(
+            TillClosure.objects.all(), group_field), options['repeat'])
+        stdout.write('{:<10} {} closures: {:8.2f}ms'.format(
+            group_field, closures, seconds * 1000))
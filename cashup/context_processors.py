@@ -1,9 +1,37 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
 from .models import Outlet
+from .utils import cache_version, bump_cache_version
+
+
+def outlet_menu_version():
+    return cache_version('cashup:outlet-menu')
+
+def invalidate_outlet_menus():
+    bump_cache_version('cashup:outlet-menu')
+
+def outlets_for_menu(personnel):
+    """
+    Returns a list of the Outlets shown in the navigation menu for
+    personnel, cached until an Outlet, StaffPosition or Personnel changes.
+    """
+    if personnel is None:
+        return []
+    key = 'cashup:outlet-menu:{}:{}'.format(
+        personnel.pk, outlet_menu_version())
+    outlets = cache.get(key)
+    if outlets is None:
+        outlets = list(Outlet.objects.for_personnel(personnel))
+        timeout = getattr(settings, "CASHUP_OUTLET_MENU_TIMEOUT", 3600)
+        cache.set(key, outlets, timeout)
+    return outlets
 
 def cashup(request):
     personnel = getattr(request.user, 'profile', None)
     extra_context = {
-        'outlets': Outlet.objects.for_personnel(personnel),
+        'outlets': SimpleLazyObject(lambda: outlets_for_menu(personnel)),
         'business': getattr(personnel, 'business', None),
     }
     return extra_context
@@ -1,11 +1,14 @@
 from django import forms
+from django.forms.models import fields_for_model
 
-from .models import Outlet, StaffPosition, Personnel
+from .models import Outlet, Personnel, TillClosure
 
 
 class OutletForm(forms.ModelForm):
     def full_clean(self):
         super(OutletForm, self).full_clean()
+        if not self.is_bound:
+            return
         try:
             self.instance.validate_unique()
         except forms.ValidationError:
@@ -15,29 +18,64 @@ class OutletForm(forms.ModelForm):
         model = Outlet
         fields = ['name', 'default_float']
 
-class StaffPositionForm(forms.ModelForm):
+class StaffChangesForm(forms.Form):
+    """
+    A change set for an Outlet's StaffPositions from the staff editor: the
+    Personnel it showed and which of them were ticked as manager or staff.
+    Owners always have access to their Outlets so can't be chosen.
+    """
+    personnel = forms.ModelMultipleChoiceField(queryset=Personnel.objects.none())
+    manager = forms.ModelMultipleChoiceField(queryset=Personnel.objects.none(),
+                                             required=False)
+    staff = forms.ModelMultipleChoiceField(queryset=Personnel.objects.none(),
+                                           required=False)
 
     def __init__(self, *args, **kwargs):
-        if 'initial' in kwargs and 'personnel' in kwargs['initial']:
-            self.personnel_name = Personnel.objects.get(
-                pk=kwargs['initial']['personnel'])
-        elif 'instance' in kwargs:
-            self.personnel_name = kwargs['instance'].personnel.name
-        super(StaffPositionForm, self).__init__(*args, **kwargs)
+        business = kwargs.pop('business')
+        super(StaffChangesForm, self).__init__(*args, **kwargs)
+        queryset = business.personnel.filter(is_owner=False)
+        for field in self.fields.values():
+            field.queryset = queryset
 
-    def full_clean(self):
-        super(StaffPositionForm, self).full_clean()
-        if not self.is_bound:
-            return
-        p = self.cleaned_data.get('personnel', None)
-        o = self.cleaned_data.get('outlet', None)
-        if p and o and p.business != o.business:
-            self._update_errors("Invalid staff choice for business")
+    def changes(self):
+        """
+        Returns a dict mapping each Personnel pk to an `(is_manager,
+        is_staff)` tuple for `StaffPosition.objects.apply_changes`.
+        """
+        managers = {p.pk for p in self.cleaned_data['manager']}
+        staff = {p.pk for p in self.cleaned_data['staff']}
+        return {p.pk: (p.pk in managers, p.pk in staff)
+                for p in self.cleaned_data['personnel']}
 
 
-    class Meta:
-        model = StaffPosition
-        fields = ['personnel', 'is_manager', 'is_staff']
+class TillClosureImportForm(forms.Form):
+    """
+    Validates a single row for `TillClosure.objects.bulk_import` or a single
+    closure posted to TillClosureBatchCreateView.
+    Outlet and Personnel are given by pk; their callers check they exist a
+    batch at a time rather than with a query per row.
+    """
+    outlet = forms.IntegerField(min_value=1)
+    closed_by = forms.IntegerField(min_value=1)
+
+    @classmethod
+    def clean_row(cls, data):
+        """
+        Cleans `data` using the form's fields directly, skipping the per
+        instance copies of every field which make bound forms slow in bulk.
+        Returns a `(cleaned_data, errors)` tuple.
+        """
+        cleaned_data, errors = {}, {}
+        for name, field in cls.base_fields.items():
+            try:
+                cleaned_data[name] = field.clean(data.get(name))
+            except forms.ValidationError as e:
+                errors[name] = e.messages
+        return cleaned_data, errors
 
-StaffFormSet = forms.inlineformset_factory(Outlet, StaffPosition,
-                                           form=StaffPositionForm)
+TillClosureImportForm.base_fields.update(fields_for_model(TillClosure,
+    fields=['close_time', 'cash_takings', 'card_takings',
+            'note_50GBP', 'note_20GBP', 'note_10GBP', 'note_5GBP',
+            'coin_2GBP', 'coin_1GBP', 'coin_50p', 'coin_20p',
+            'coin_10p', 'coin_5p', 'coin_2p', 'coin_1p', 'till_float',
+            'notes']))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from cashup.models import TillClosure
+
+
+class Command(BaseCommand):
+    help = ('Moves superseded till closure versions out of the till closure '
+            'table and into the archive.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        archived = TillClosure.audit_trail.archive_superseded(
+            batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Archived {} superseded versions'.format(archived)))
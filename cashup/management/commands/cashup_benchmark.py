@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cashup.benchmarks import BENCHMARKS, find_regressions
+
+
+class Command(BaseCommand):
+    help = ('Runs cashup performance benchmarks. Seeded data is rolled back '
+            'afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+            help='One or more of: {}. Defaults to all.'.format(
+                ', '.join(BENCHMARKS)))
+        parser.add_argument('--repeat', type=int, default=5,
+            help='Number of timed runs; the best is reported.')
+        parser.add_argument('--requests', type=int, default=20,
+            help='Number of timed requests per URL and role.')
+        parser.add_argument('--businesses', type=int, default=3)
+        parser.add_argument('--outlets', type=int, default=100,
+            help='Outlets per business.')
+        parser.add_argument('--personnel', type=int, default=1000,
+            help='Personnel per business.')
+        parser.add_argument('--closures', type=int, default=1000000,
+            help='Till closures across all businesses.')
+        parser.add_argument('--json', metavar='PATH',
+            help='Write the results to PATH as JSON.')
+        parser.add_argument('--baseline', metavar='PATH',
+            help='Fail if results have regressed from the JSON at PATH.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+            help='Fractional increase in latency or memory allowed against '
+                 'the baseline. Any increase in queries is a regression.')
+
+    def handle(self, *args, **options):
+        names = options['benchmarks'] or list(BENCHMARKS)
+        results = {}
+        for name in names:
+            if name not in BENCHMARKS:
+                self.stderr.write('Unknown benchmark: {}'.format(name))
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            with transaction.atomic():
+                result = BENCHMARKS[name](self.stdout, options)
+                transaction.set_rollback(True)
+            if result is not None:
+                results[name] = result
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = find_regressions(
+                results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressed from {}:\n{}'.format(
+                    options['baseline'], '\n'.join(regressions)))
+            self.stdout.write(self.style.SUCCESS(
+                'No regressions from {}'.format(options['baseline'])))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from cashup.models import TillClosure
+
+
+class Command(BaseCommand):
+    help = ('Converts the full copies of superseded till closure versions '
+            'into deltas against the version after them.')
+
+    def handle(self, *args, **options):
+        converted = TillClosure.audit_trail.compact_history()
+        self.stdout.write(self.style.SUCCESS(
+            'Converted {} superseded versions'.format(converted)))
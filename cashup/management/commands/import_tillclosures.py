@@ -0,0 +1,68 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cashup.models import Business, TillClosure
+
+
+class Command(BaseCommand):
+    help = ('Imports historical till closures for a business from CSV or '
+            'JSON Lines. The outlet column holds the outlet slug and the '
+            'closed_by column the username of the person who closed the '
+            'till; other columns match the till closure form fields.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('business', type=int, help='Business pk')
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+            help='Input format. Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            business = Business.objects.get(pk=options['business'])
+        except Business.DoesNotExist:
+            raise CommandError('Business {} does not exist'.format(
+                options['business']))
+        self.outlets = dict(
+            business.outlets.values_list('slug', 'pk'))
+        self.personnel = dict(
+            business.personnel.values_list('user__username', 'pk'))
+
+        path = options['path']
+        fmt = options['format'] or (
+            'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        stream = sys.stdin if path == '-' else open(path, newline='')
+        try:
+            if fmt == 'csv':
+                rows = csv.DictReader(stream)
+            else:
+                rows = (json.loads(line) for line in stream if line.strip())
+            result = TillClosure.objects.bulk_import(
+                (self.resolve(row) for row in rows),
+                batch_size=options['batch_size'],
+                progress=self.progress)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for row_number, errors in result.errors:
+            self.stderr.write('Row {}: {}'.format(row_number, '; '.join(
+                '{}: {}'.format(field, ' '.join(messages))
+                for field, messages in errors.items())))
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {} till closures ({} rows rejected)'.format(
+                result.created, len(result.errors))))
+
+    def resolve(self, row):
+        """Swaps outlet slug and username for pks."""
+        row = dict(row)
+        row['outlet'] = self.outlets.get(row.get('outlet'))
+        row['closed_by'] = self.personnel.get(row.get('closed_by'))
+        return row
+
+    def progress(self, read, created, elapsed):
+        self.stdout.write('{} rows read, {} created, {:.0f} rows/s'.format(
+            read, created, read / elapsed if elapsed else 0))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from cashup.models import OutletDailyTotal
+
+
+class Command(BaseCommand):
+    help = ('Recalculates the per outlet daily totals from the current till '
+            'closures.')
+
+    def handle(self, *args, **options):
+        OutletDailyTotal.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt {} daily totals'.format(OutletDailyTotal.objects.count())))
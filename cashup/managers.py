@@ -1,15 +1,293 @@
-import operator
-from functools import reduce
+import time
+from collections import namedtuple, defaultdict
+from itertools import islice
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, connections, router, transaction
+from django.db.models import (Q, F, Exists, OuterRef, Subquery, Sum, Count,
+                              Value, DecimalField, ExpressionWrapper)
+from django.db.models.functions import TruncDate, Coalesce
+from django.utils import timezone
 
-class AuditTrailManager(models.Manager):
+from .modelfields import DenominationCountField
+
+
+BulkImportResult = namedtuple('BulkImportResult', ['created', 'errors'])
+
+
+class TillClosureQuerySet(models.QuerySet):
+    def with_deleted_status(self):
+        """
+        Annotates each TillClosure with `current_version_exists` so that
+        `TillClosure.is_deleted` can be answered without a query per row.
+        """
+        current_version = self.model.audit_trail.filter(
+            pk=OuterRef('identity'), version_superseded_time=None)
+        return self.annotate(current_version_exists=Exists(current_version))
+
+    def allocate_pks(self, count):
+        """
+        Reserves `count` primary keys from the table's sequence so that new
+        TillClosures can be inserted with `identity` already set.
+        Returns None on backends without sequences.
+        """
+        using = self._db or router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.vendor != 'postgresql':
+            return None
+        opts = self.model._meta
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                'FROM generate_series(1, %s)',
+                [opts.db_table, opts.pk.column, count])
+            return [row[0] for row in cursor.fetchall()]
+
+    def bulk_import(self, rows, batch_size=500, progress=None):
+        """
+        Creates TillClosures from an iterable of dicts, as for historical
+        data. Each row holds `outlet` and `closed_by` pks plus the fields of
+        the till closure form; blank denomination counts are taken as 0.
+        Rows are validated and written `batch_size` at a time, each batch in
+        its own transaction, so memory use doesn't grow with the input.
+        Derived totals and versioning fields are filled in as by
+        `TillClosure.save`.
+        Optional `progress` is called after each batch with the number of
+        rows read, closures created and seconds elapsed so far.
+        Returns a BulkImportResult of the number created and a list of
+        `(row number, errors)` for rows which failed validation.
+        """
+        from .forms import TillClosureImportForm
+
+        Outlet = self.model._meta.get_field('outlet').related_model
+        Personnel = self.model._meta.get_field('closed_by').related_model
+        denominations = [f.name for f in self.model._meta.fields
+                         if isinstance(f, DenominationCountField)]
+        using = self._db or router.db_for_write(self.model)
+        rows = iter(rows)
+        start = time.time()
+        read = created = 0
+        errors = []
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            valid = []
+            for row in batch:
+                read += 1
+                data = dict.fromkeys(denominations, 0)
+                data.update(
+                    (k, v) for k, v in row.items() if v not in ('', None))
+                data, row_errors = TillClosureImportForm.clean_row(data)
+                if row_errors:
+                    errors.append((read, row_errors))
+                else:
+                    valid.append((read, data))
+
+            outlets = dict(Outlet.objects.using(using).filter(
+                pk__in={data['outlet'] for n, data in valid}
+            ).values_list('pk', 'business_id'))
+            personnel = dict(Personnel.objects.using(using).filter(
+                pk__in={data['closed_by'] for n, data in valid}
+            ).values_list('pk', 'business_id'))
+            accepted = []
+            for row_number, data in valid:
+                business = outlets.get(data['outlet'])
+                if business is None:
+                    errors.append((row_number, {'outlet': ['Unknown outlet']}))
+                elif personnel.get(data['closed_by']) != business:
+                    errors.append((row_number,
+                        {'closed_by': ['Unknown personnel for business']}))
+                else:
+                    accepted.append(data)
+
+            if accepted:
+                self.using(using).create_batch(accepted)
+                created += len(accepted)
+            if progress is not None:
+                progress(read, created, time.time() - start)
+        return BulkImportResult(created, errors)
+
+    def create_batch(self, rows):
+        """
+        Creates a TillClosure from each of `rows`, dicts of cleaned
+        TillClosureImportForm data, in one transaction. The outlets' daily
+        totals are updated once per day rather than once per closure.
+        Returns the created TillClosures.
+        """
+        from .signals import tillclosures_created
+
+        using = self._db or router.db_for_write(self.model)
+        closures = [self._import_closure(data) for data in rows]
+        with transaction.atomic(using=using):
+            self._insert_closures(closures, using)
+            self.model._meta.apps.get_model(
+                'cashup', 'OutletDailyTotal'
+            ).objects.db_manager(using).record(added=closures)
+        tillclosures_created.send(sender=self.model, closures=closures)
+        return closures
+
+    def _import_closure(self, data):
+        data = dict(data)
+        data['outlet_id'] = data.pop('outlet')
+        data['closed_by_id'] = data['updated_by_id'] = data.pop('closed_by')
+        for field in self.model._meta.fields:
+            if isinstance(field, DenominationCountField):
+                data[field.name] = field.to_python(data[field.name])
+        closure = self.model(**data)
+        closure.calculate_totals()
+        return closure
+
+    def _insert_closures(self, closures, using):
+        """
+        Inserts new closures with `identity` set to their pk and version 1,
+        as `TillClosure.save` leaves a new closure.
+        Where the table has a sequence the pks are reserved up front, so the
+        rows are written complete. Otherwise the first closure is inserted
+        alone for its pk, P, and the rest are bulk inserted with no identity
+        and P + 1 as a version number, which only this batch can hold while
+        the identity is NULL. Their pks are then read back and every row in
+        the batch has its identity set with one UPDATE.
+        """
+        if not closures:
+            return
+        manager = self.model.audit_trail.db_manager(using)
+        now = timezone.now()
+        for closure in closures:
+            closure.version_number = 1
+            closure.object_created_time = now
+            closure.version_created_time = now
+        pks = manager.allocate_pks(len(closures))
+        if pks is not None:
+            for closure, pk in zip(closures, pks):
+                closure.pk = closure.identity = pk
+            # left to the backend to split, as some limit how many rows one
+            # INSERT may hold
+            manager.bulk_create(closures)
+            return
+
+        first, rest = closures[0], closures[1:]
+        first.identity = None
+        # Model.save skips TillClosure's versioning
+        models.Model.save(first, force_insert=True, using=using)
+        token = first.pk + 1
+        rows = Q(pk=first.pk)
+        if rest:
+            for closure in rest:
+                closure.identity = None
+                closure.version_number = token
+            manager.bulk_create(rest)
+            placeholders = Q(identity=None, version_number=token)
+            pks = manager.filter(placeholders).order_by('pk').values_list(
+                'pk', flat=True)
+            for closure, pk in zip(rest, pks):
+                closure.pk = pk
+            rows |= placeholders
+        manager.filter(rows).update(identity=F('pk'), version_number=1)
+        for closure in closures:
+            closure.identity = closure.pk
+            closure.version_number = 1
+
+    def compact_history(self):
+        """
+        Replaces the full copies of superseded versions in this queryset
+        with TillClosureDeltas, one closure per transaction.
+        Returns the number of versions converted.
+        """
+        TillClosureDelta = self.model._meta.apps.get_model(
+            'cashup', 'TillClosureDelta')
+        using = self._db or router.db_for_write(self.model)
+        identities = list(self.exclude(pk=F('identity')).order_by(
+            'identity').values_list('identity', flat=True).distinct())
+        converted = 0
+        for identity in identities:
+            with transaction.atomic(using=using):
+                current = self.model.audit_trail.using(using).get(pk=identity)
+                versions = current._build_versions()
+                superseded = [(version, next_version) for version, next_version
+                              in zip(versions, versions[1:])
+                              if version.pk and version.pk != identity]
+                TillClosureDelta.objects.using(using).bulk_create(
+                    TillClosureDelta.between(version, next_version)
+                    for version, next_version in superseded)
+                self.model.audit_trail.using(using).filter(
+                    pk__in=[version.pk for version, n in superseded]).delete()
+            converted += len(superseded)
+        return converted
+
+
+    def archive_superseded(self, batch_size=1000):
+        """
+        Moves the full copies of superseded versions in this queryset to
+        ArchivedTillClosure, `batch_size` at a time, each batch in its own
+        transaction. Returns the number of versions archived.
+        """
+        ArchivedTillClosure = self.model._meta.apps.get_model(
+            'cashup', 'ArchivedTillClosure')
+        using = self._db or router.db_for_write(self.model)
+        superseded = self.using(using).exclude(pk=F('identity')).order_by('pk')
+        archived = 0
+        while True:
+            with transaction.atomic(using=using):
+                batch = list(superseded[:batch_size])
+                if not batch:
+                    break
+                ArchivedTillClosure.objects.using(using).bulk_create(
+                    ArchivedTillClosure.from_version(version)
+                    for version in batch)
+                self.model.audit_trail.using(using).filter(
+                    pk__in=[version.pk for version in batch]).delete()
+            archived += len(batch)
+        return archived
+
+
+class AuditTrailManager(models.Manager.from_queryset(TillClosureQuerySet)):
     def get_queryset(self):
         return super(AuditTrailManager, self).get_queryset().filter(
             version_superseded_time=None)
 
 
+class StaffPositionQuerySet(models.QuerySet):
+    def apply_changes(self, outlet, changes):
+        """
+        Updates the StaffPositions of `outlet` from `changes`, a dict mapping
+        Personnel pk to an `(is_manager, is_staff)` tuple. Personnel with
+        neither flag set lose their position.
+        New positions are written with one bulk_create, changed ones with an
+        update per combination of flags and removed ones with one delete.
+        Returns a dict of the number created, updated and deleted.
+        """
+        from .signals import staff_positions_changed
+
+        existing = {position.personnel_id: position for position in
+                    self.filter(outlet=outlet, personnel__in=list(changes))}
+        created, deleted = [], []
+        updated = defaultdict(list)
+        for personnel_id, flags in changes.items():
+            position = existing.get(personnel_id)
+            if not any(flags):
+                if position is not None:
+                    deleted.append(position.pk)
+            elif position is None:
+                created.append(self.model(
+                    outlet=outlet, personnel_id=personnel_id,
+                    is_manager=flags[0], is_staff=flags[1]))
+            elif (position.is_manager, position.is_staff) != tuple(flags):
+                updated[tuple(flags)].append(position.pk)
+
+        with transaction.atomic(using=self.db):
+            self.bulk_create(created)
+            for (is_manager, is_staff), pks in updated.items():
+                self.filter(pk__in=pks).update(
+                    is_manager=is_manager, is_staff=is_staff)
+            self.filter(pk__in=deleted).delete()
+        counts = {'created': len(created),
+                  'updated': sum(len(pks) for pks in updated.values()),
+                  'deleted': len(deleted)}
+        if any(counts.values()):
+            staff_positions_changed.send(sender=self.model, outlet=outlet)
+        return counts
+
+
 class OutletQuerySet(models.QuerySet):
     def for_personnel(self, personnel, is_manager=False):
         """
@@ -19,14 +297,120 @@ class OutletQuerySet(models.QuerySet):
         Optional `is_manager` determines wether (for non-owners) the returned
         queryset will include Outlets they are staff of or just ones they
         manage.
+        Uses EXISTS subqueries rather than joins so no DISTINCT is needed.
+        """
+        Personnel = self.model._meta.get_field('personnel').related_model
+        StaffPosition = self.model._meta.get_field('staff').related_model
+        pk = getattr(personnel, 'pk', personnel)
+        owners = Personnel.objects.filter(
+            pk=pk, is_owner=True, business=OuterRef('business'))
+        positions = StaffPosition.objects.filter(
+            personnel=pk, outlet=OuterRef('pk'))
+        if is_manager:
+            positions = positions.filter(is_manager=True)
+        else:
+            positions = positions.filter(Q(is_manager=True) | Q(is_staff=True))
+        return self.annotate(
+            personnel_is_owner=Exists(owners),
+            personnel_has_position=Exists(positions),
+        ).filter(
+            Q(personnel_is_owner=True) | Q(personnel_has_position=True)
+        ).order_by('name')
+
+    def with_totals(self, start, end):
         """
-        filters = [
-            Q(business__personnel=personnel) &
-                Q(business__personnel__is_owner=True),
-            Q(staff__is_manager=True) & Q(staff__personnel=personnel)
-        ]
-        if not is_manager:
-            filters.append(
-                Q(staff__is_staff=True) & Q(staff__personnel=personnel))
-        q_obj = reduce(operator.or_, filters)
-        return self.filter(q_obj).distinct().order_by('name')
+        Annotates each Outlet with its closure count and takings between
+        the `start` and `end` dates (inclusive) from its daily totals, in a
+        single query. Each is a subquery of the outlet's days in the range,
+        so days outside it aren't read. Outlets without closures get zeros.
+        """
+        DailyTotal = self.model._meta.get_field('daily_totals').related_model
+        days = DailyTotal.objects.filter(
+            outlet=OuterRef('pk'), date__range=(start, end)
+        ).order_by().values('outlet')
+        def total(name, output_field):
+            return Coalesce(Subquery(
+                days.annotate(total=Sum(name)).values('total'),
+                output_field=output_field), Value(0))
+        amount = DecimalField(max_digits=14, decimal_places=2)
+        return self.annotate(
+            closures=total('closures', models.IntegerField()),
+            cash_takings=total('cash_takings', amount),
+            card_takings=total('card_takings', amount),
+            total_takings=total('total_takings', amount),
+            till_difference=total('till_difference', amount),
+            to_bank=total('to_bank', amount),
+        )
+
+
+class DailyTotalQuerySet(models.QuerySet):
+    amount_fields = ('cash_takings', 'card_takings', 'total_takings',
+                     'till_difference', 'to_bank')
+
+    def totals(self):
+        """Sums the closures and amounts of the selected days."""
+        return self.aggregate(closures=Sum('closures'), **{
+            name: Sum(name) for name in self.amount_fields})
+
+    def record(self, added=(), removed=()):
+        """
+        Adds the amounts of `added` TillClosures to their outlet's total for
+        the (local) day they were closed and subtracts those of `removed`.
+        Changes to the same day are combined first, so an edit which leaves
+        the amounts and day alone doesn't write anything. Days left without
+        closures are deleted, as `rebuild` wouldn't create them. Should be
+        called in the transaction which changes the closures.
+        """
+        changes = defaultdict(lambda: defaultdict(int))
+        for closures, sign in ((added, 1), (removed, -1)):
+            for closure in closures:
+                key = (closure.outlet_id,
+                       timezone.localtime(closure.close_time).date())
+                changes[key]['closures'] += sign
+                for name in self.amount_fields:
+                    changes[key][name] += sign * getattr(closure, name)
+        for (outlet_id, date), deltas in changes.items():
+            if not any(deltas.values()):
+                continue
+            updated = self.filter(outlet_id=outlet_id, date=date).update(
+                **{name: F(name) + delta for name, delta in deltas.items()})
+            # a missing day only needs creating when closures are added;
+            # otherwise its outlet is being deleted (or it needs a rebuild)
+            if not updated and deltas['closures'] > 0:
+                self._create_day(outlet_id, date, deltas)
+            elif updated and deltas['closures'] < 0:
+                self.filter(outlet_id=outlet_id, date=date,
+                            closures__lte=0).delete()
+
+    def _create_day(self, outlet_id, date, deltas):
+        total, created = self.get_or_create(
+            outlet_id=outlet_id, date=date, defaults=deltas)
+        if not created:
+            # another transaction created the row first
+            self.filter(pk=total.pk).update(
+                **{name: F(name) + delta for name, delta in deltas.items()})
+
+    def rebuild(self):
+        """
+        Replaces all totals with ones calculated from the current
+        TillClosures, for when they may have drifted (or don't exist yet).
+        """
+        TillClosure = self.model._meta.apps.get_model('cashup', 'TillClosure')
+        to_bank = ExpressionWrapper(F('till_total') - F('till_float'),
+            output_field=DecimalField(max_digits=12, decimal_places=2))
+        days = TillClosure._default_manager.filter(
+            version_superseded_time=None).annotate(
+                date=TruncDate('close_time')).order_by().values(
+                    'outlet_id', 'date').annotate(
+                        closures=Count('pk'), to_bank=Sum(to_bank), **{
+                            name: Sum(name) for name in self.amount_fields
+                            if name != 'to_bank'})
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            self.bulk_create(
+                [self.model(**day) for day in days.iterator()],
+                batch_size=500)
+
+
+class DailyTotalManager(models.Manager.from_queryset(DailyTotalQuerySet)):
+    use_in_migrations = True
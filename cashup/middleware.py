@@ -0,0 +1,150 @@
+import logging
+import threading
+import timeit
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from rules.permissions import permissions
+
+logger = logging.getLogger('cashup.profile')
+
+_rules_timing = threading.local()
+
+
+def _instrument_rules():
+    """
+    Wraps the rules permission set so that time spent testing predicates
+    is added to the current thread's totals. Only done once, and only when
+    profiling is enabled.
+    """
+    if getattr(permissions, '_cashup_profiled', False):
+        return
+    test_rule = permissions.test_rule
+
+    def timed_test_rule(*args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return test_rule(*args, **kwargs)
+        finally:
+            if getattr(_rules_timing, 'active', False):
+                _rules_timing.checks += 1
+                _rules_timing.time += timeit.default_timer() - start
+    permissions.test_rule = timed_test_rule
+    permissions._cashup_profiled = True
+
+
+class RequestProfileMiddleware(object):
+    """
+    Reports the query count, SQL time, duplicated queries and time spent
+    in rules predicates of each request to a cashup view, as Server-Timing
+    headers and a log line on the `cashup.profile` logger.
+    A streamed response, such as an export, runs most of its queries while
+    it's read, so it's reported once read to the end (or closed) and only
+    in the log, as its headers have been sent by then.
+    Enabled by the CASHUP_PROFILE_REQUESTS setting; otherwise Django drops
+    the middleware when it's loaded.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'CASHUP_PROFILE_REQUESTS', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        _instrument_rules()
+
+    def __call__(self, request):
+        profile = self.start()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.stop(profile)
+            raise
+
+        match = request.resolver_match
+        view = match and '{}.{}'.format(match.func.__module__,
+                                        match.func.__name__)
+        if not (view and view.startswith('cashup.')):
+            self.stop(profile)
+        elif response.streaming:
+            response.streaming_content = ProfiledStream(
+                response.streaming_content, lambda: self.report(
+                    request, response, view, *self.stop(profile)))
+        else:
+            self.report(request, response, view, *self.stop(profile))
+        return response
+
+    def start(self):
+        debug_cursors = [(c, c.force_debug_cursor) for c in connections.all()]
+        offsets = []
+        for connection, force_debug_cursor in debug_cursors:
+            connection.force_debug_cursor = True
+            offsets.append(len(connection.queries_log))
+        _rules_timing.active = True
+        _rules_timing.checks = 0
+        _rules_timing.time = 0
+        return debug_cursors, offsets, timeit.default_timer()
+
+    def stop(self, profile):
+        """Returns the queries run and seconds taken since `start`."""
+        debug_cursors, offsets, start = profile
+        total = timeit.default_timer() - start
+        _rules_timing.active = False
+        queries = []
+        for (connection, force_debug_cursor), offset in zip(
+                debug_cursors, offsets):
+            connection.force_debug_cursor = force_debug_cursor
+            queries.extend(list(connection.queries_log)[offset:])
+        return queries, total
+
+    def report(self, request, response, view, queries, total):
+        sql_time = sum(float(query['time']) for query in queries)
+        repeated = Counter(query['sql'] for query in queries).most_common(1)
+        duplicates = len(queries) - len({query['sql'] for query in queries})
+        stats = {
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'queries': len(queries),
+            'duplicates': duplicates,
+            'sql_ms': round(sql_time * 1000, 2),
+            'rules_checks': _rules_timing.checks,
+            'rules_ms': round(_rules_timing.time * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+        }
+        if not response.streaming:
+            response['Server-Timing'] = ', '.join([
+                'db;dur={sql_ms};desc="{queries} queries, {duplicates} '
+                'duplicates"'.format(**stats),
+                'rules;dur={rules_ms};desc="{rules_checks} checks"'.format(
+                    **stats),
+                'total;dur={total_ms}'.format(**stats),
+            ])
+        if duplicates:
+            stats['most_duplicated_sql'] = repeated[0][0]
+        logger.info(' '.join('{}={}'.format(key, stats[key]) for key in (
+            'path', 'view', 'status', 'queries', 'duplicates', 'sql_ms',
+            'rules_checks', 'rules_ms', 'total_ms')), extra=stats)
+
+
+class ProfiledStream(object):
+    """
+    Wraps the content of a streamed response to call `on_finish` once,
+    when it has been read to the end or the response is closed.
+    """
+    def __init__(self, content, on_finish):
+        self.content = content
+        self.on_finish = on_finish
+        self.finished = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.content:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.on_finish()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Partial indexes covering only the current row of each closure (the row
+# where id = identity), which is what the closure list views filter on.
+# Only created on backends that support partial indexes.
+PARTIAL_INDEX_BACKENDS = ('postgresql', 'sqlite')
+
+PARTIAL_INDEXES = [
+    ('cashup_till_outlet_takings_current_idx', 'outlet_id', 'total_takings'),
+    ('cashup_till_outlet_diff_current_idx', 'outlet_id', 'till_difference'),
+    ('cashup_till_closer_takings_current_idx', 'closed_by_id', 'total_takings'),
+    ('cashup_till_closer_diff_current_idx', 'closed_by_id', 'till_difference'),
+]
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in PARTIAL_INDEX_BACKENDS:
+        return
+    for name, column, order_column in PARTIAL_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX {} ON cashup_tillclosure ({}, {}) '
+            'WHERE id = identity'.format(name, column, order_column))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in PARTIAL_INDEX_BACKENDS:
+        return
+    for name, column, order_column in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashup', '0007_auto_20170117_1927'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='tillclosure',
+            unique_together=set([('identity', 'version_number')]),
+        ),
+        migrations.AddIndex(
+            model_name='tillclosure',
+            index=models.Index(fields=['outlet', 'close_time'], name='cashup_till_outlet_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tillclosure',
+            index=models.Index(fields=['closed_by', 'close_time'], name='cashup_till_closer_time_idx'),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
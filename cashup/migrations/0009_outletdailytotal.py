@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:25
+from __future__ import unicode_literals
+
+import cashup.managers
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_daily_totals(apps, schema_editor):
+    apps.get_model('cashup', 'OutletDailyTotal').objects.rebuild()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashup', '0008_tillclosure_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutletDailyTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('closures', models.IntegerField(default=0)),
+                ('cash_takings', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('card_takings', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('total_takings', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('till_difference', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('to_bank', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+            managers=[
+                ('objects', cashup.managers.DailyTotalManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='outletdailytotal',
+            name='outlet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_totals', to='cashup.Outlet'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='outletdailytotal',
+            unique_together=set([('outlet', 'date')]),
+        ),
+        migrations.RunPython(build_daily_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashup', '0009_outletdailytotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TillClosureDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identity', models.PositiveIntegerField()),
+                ('version_number', models.PositiveIntegerField()),
+                ('version_created_time', models.DateTimeField()),
+                ('version_superseded_time', models.DateTimeField()),
+                ('changes', models.TextField()),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='cashup.Personnel')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tillclosuredelta',
+            unique_together=set([('identity', 'version_number')]),
+        ),
+    ]
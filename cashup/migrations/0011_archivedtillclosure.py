@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:33
+from __future__ import unicode_literals
+
+import cashup.modelfields
+import cashup.models
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashup', '0010_tillclosuredelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTillClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('close_time', models.DateTimeField(default=cashup.models.time)),
+                ('cash_takings', models.DecimalField(decimal_places=2, max_digits=12, validators=[django.core.validators.MinValueValidator(Decimal('0.00'))])),
+                ('card_takings', models.DecimalField(decimal_places=2, max_digits=12, validators=[django.core.validators.MinValueValidator(Decimal('0.00'))])),
+                ('total_takings', models.DecimalField(decimal_places=2, editable=False, max_digits=12)),
+                ('note_50GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=5000, verbose_name='£50 notes')),
+                ('note_20GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=2000, verbose_name='£20 notes')),
+                ('note_10GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=1000, verbose_name='£10 notes')),
+                ('note_5GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=500, verbose_name='£5 notes')),
+                ('coin_2GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=200, verbose_name='£2 coins')),
+                ('coin_1GBP', cashup.modelfields.DenominationCountField(default=0, pence_value=100, verbose_name='£1 coins')),
+                ('coin_50p', cashup.modelfields.DenominationCountField(default=0, pence_value=50, verbose_name='50p coins')),
+                ('coin_20p', cashup.modelfields.DenominationCountField(default=0, pence_value=20, verbose_name='20p coins')),
+                ('coin_10p', cashup.modelfields.DenominationCountField(default=0, pence_value=10, verbose_name='10p coins')),
+                ('coin_5p', cashup.modelfields.DenominationCountField(default=0, pence_value=5, verbose_name='5p coins')),
+                ('coin_2p', cashup.modelfields.DenominationCountField(default=0, pence_value=2, verbose_name='2p coins')),
+                ('coin_1p', cashup.modelfields.DenominationCountField(default=0, pence_value=1, verbose_name='1p coins')),
+                ('till_total', models.DecimalField(decimal_places=2, editable=False, max_digits=12)),
+                ('till_float', models.DecimalField(decimal_places=2, max_digits=12, validators=[django.core.validators.MinValueValidator(Decimal('0.00'))])),
+                ('till_difference', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('notes', models.TextField(blank=True, help_text='Add any useful info here')),
+                ('identity', models.PositiveIntegerField(blank=True, editable=False)),
+                ('version_number', models.PositiveIntegerField(blank=True, editable=False)),
+                ('object_created_time', models.DateTimeField(blank=True, editable=False)),
+                ('version_created_time', models.DateTimeField(blank=True, editable=False)),
+                ('version_superseded_time', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('closed_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archivedtillclosures', to='cashup.Personnel')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedtillclosure',
+            name='outlet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archivedtillclosures', to='cashup.Outlet'),
+        ),
+        migrations.AddField(
+            model_name='archivedtillclosure',
+            name='updated_by',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='updated_archivedtillclosures', to='cashup.Personnel'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivedtillclosure',
+            unique_together=set([('identity', 'version_number')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:12
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+
+indexes = import_module('cashup.migrations.0008_tillclosure_indexes')
+
+
+def recreate_partial_indexes(apps, schema_editor):
+    # SQLite alters a column by copying the table, which loses the partial
+    # indexes created in SQL by 0008
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    indexes.drop_partial_indexes(apps, schema_editor)
+    indexes.create_partial_indexes(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashup', '0011_archivedtillclosure'),
+    ]
+
+    operations = [
+        # run after the column is altered in either direction
+        migrations.RunPython(migrations.RunPython.noop,
+                             recreate_partial_indexes),
+        migrations.AlterField(
+            model_name='tillclosure',
+            name='identity',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(recreate_partial_indexes,
+                             migrations.RunPython.noop),
+    ]
@@ -11,7 +11,7 @@ class DenominationCount(object):
 
     @property
     def value(self):
-        return Decimal(self.count * self.pence_value * 0.01)
+        return Decimal(self.count * self.pence_value).scaleb(-2)
 
     @property
     def pretty_value(self):
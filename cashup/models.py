@@ -1,13 +1,20 @@
+import copy
+import datetime
+import json
+import operator
 from decimal import Decimal
 
 from django.db import models, transaction
 from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.urls import reverse
 from django.utils import timezone
 from django.core.validators import MinValueValidator, RegexValidator
 
-from .modelfields import DenominationCountField
-from .managers import AuditTrailManager, OutletQuerySet
+from .modelfields import DenominationCount, DenominationCountField
+from .managers import (AuditTrailManager, OutletQuerySet, TillClosureQuerySet,
+                       DailyTotalManager, StaffPositionQuerySet)
 
 def time():
     return timezone.now().replace(second=0, microsecond=0)
@@ -102,6 +109,8 @@ class StaffPosition(models.Model):
     is_manager = models.BooleanField(default=False)
     is_staff = models.BooleanField(default=False)
 
+    objects = StaffPositionQuerySet.as_manager()
+
     @property
     def title(self):
         return 'Manager' if self.is_manager else "Staff"
@@ -114,9 +123,13 @@ class StaffPosition(models.Model):
         unique_together = ('outlet', 'personnel')
 
 
-class TillClosure(models.Model):
-    outlet = models.ForeignKey(Outlet, related_name='tillclosures')
-    closed_by = models.ForeignKey(Personnel, related_name='tillclosures',
+class AbstractTillClosure(models.Model):
+    """
+    The fields of a till closure version, shared by current versions in
+    TillClosure and superseded ones moved to ArchivedTillClosure.
+    """
+    outlet = models.ForeignKey(Outlet, related_name='%(class)ss')
+    closed_by = models.ForeignKey(Personnel, related_name='%(class)ss',
         on_delete=models.CASCADE)
     close_time = models.DateTimeField(default=time)
 
@@ -157,17 +170,32 @@ class TillClosure(models.Model):
     version_created_time = models.DateTimeField(editable=False, blank=True)
     version_superseded_time = models.DateTimeField(editable=False, blank=True, null=True)
     updated_by = models.ForeignKey(Personnel, null=True, editable=False, blank=True,
-        related_name='updated_tillclosures', on_delete=models.PROTECT)
+        related_name='updated_%(class)ss', on_delete=models.PROTECT)
+
+    class Meta:
+        abstract = True
+
+
+class TillClosure(AbstractTillClosure):
+    # null only while a new closure is inserted without a reserved pk; NULLs
+    # never clash in the (identity, version_number) constraint, so
+    # concurrent inserts don't wait on or fail against each other
+    identity = models.PositiveIntegerField(editable=False, blank=True,
+                                           null=True)
 
     objects = AuditTrailManager()
-    audit_trail = models.Manager()
+    audit_trail = TillClosureQuerySet.as_manager()
 
     def total(self):
-        denominations = [self.note_50GBP, self.note_20GBP, self.note_10GBP,
-                         self.note_5GBP, self.coin_2GBP, self.coin_1GBP,
-                         self.coin_50p, self.coin_20p, self.coin_10p,
-                         self.coin_5p, self.coin_2p, self.coin_1p]
-        return sum([d.value for d in denominations])
+        # counts may be plain ints if assigned directly rather than via a form
+        counts = [getattr(d, 'count', d) for d in DENOMINATIONS(self)]
+        pence = sum(map(operator.mul, counts, DENOMINATION_PENCE_VALUES))
+        return Decimal(pence).scaleb(-2)
+
+    def calculate_totals(self):
+        self.total_takings = self.cash_takings + self.card_takings
+        self.till_total = self.total()
+        self.till_difference = self.till_total - self.cash_takings - self.till_float
 
     @property
     def to_bank(self):
@@ -175,36 +203,143 @@ class TillClosure(models.Model):
 
     @property
     def is_deleted(self):
+        if hasattr(self, 'current_version_exists'):
+            return not self.current_version_exists
         return not TillClosure.objects.filter(
             pk=self.identity, version_superseded_time=None).exists()
 
+    @staticmethod
+    def _snapshot(values):
+        # DenominationCounts are mutable, so the live instance gets its own
+        return [copy.copy(value) if isinstance(value, DenominationCount)
+                else value for value in values]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TillClosure, cls).from_db(db, field_names, values)
+        if len(field_names) == len(cls._meta.concrete_fields):
+            instance._loaded_values = (field_names, cls._snapshot(values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(TillClosure, self).refresh_from_db(using, fields)
+        if fields is None and not self.get_deferred_fields():
+            field_names = [f.attname for f in self._meta.concrete_fields]
+            self._loaded_values = (field_names, self._snapshot(
+                [getattr(self, name) for name in field_names]))
+        else:
+            self.__dict__.pop('_loaded_values', None)
+
+    def _previous_version(self):
+        """
+        Returns an unsaved copy of this closure as it was loaded from the
+        database.
+        The row captured in `from_db` is used where available so the current
+        row doesn't need to be fetched again.
+        """
+        if hasattr(self, '_loaded_values'):
+            superseded = TillClosure(**dict(zip(*self._loaded_values)))
+        else:
+            superseded = TillClosure.objects.get(pk=self.pk)
+        superseded.pk = None
+        return superseded
+
     @transaction.atomic
     def save(self, duplicate=True, *args, **kwargs):
         new_obj = False
+        superseded = None
+        removed = []
         if duplicate:
             time = timezone.now()
             if not self.pk:
-                new_obj = True
-                self.identity = 0 # dummy value - will be fixed later
+                pks = TillClosure.audit_trail.db_manager(
+                    kwargs.get('using')).allocate_pks(1)
+                if pks:
+                    self.pk = self.identity = pks[0]
+                    kwargs['force_insert'] = True
+                else:
+                    new_obj = True
+                    self.identity = None # set to the pk once inserted
                 self.version_number = 1
                 self.object_created_time = time
                 self.version_created_time = time
             else:
-                tc = TillClosure.objects.get(pk=self.pk)
-                tc.pk = None
-                tc.version_superseded_time = time
-                tc.save(duplicate=False)
+                superseded = self._previous_version()
+                if superseded.version_superseded_time is None:
+                    removed.append(superseded)
+                superseded.version_superseded_time = time
 
                 self.version_number = self.version_number + 1
                 self.version_created_time = time
 
-            self.total_takings = self.cash_takings + self.card_takings
-            self.till_total = self.total()
-            self.till_difference = self.till_total - self.cash_takings - self.till_float
+            self.calculate_totals()
         super(TillClosure, self).save(*args, **kwargs)
+        if duplicate:
+            OutletDailyTotal.objects.db_manager(kwargs.get('using')).record(
+                added=[self] if self.version_superseded_time is None else [],
+                removed=removed)
+        if superseded is not None:
+            if getattr(settings, 'CASHUP_AUDIT_DELTAS', False):
+                TillClosureDelta.between(superseded, self).save(
+                    using=kwargs.get('using'))
+            elif getattr(settings, 'CASHUP_ARCHIVE_SUPERSEDED', False):
+                ArchivedTillClosure.from_version(superseded).save(
+                    using=kwargs.get('using'))
+            else:
+                # saved after self so (identity, version_number) stays unique;
+                # Model.save is called directly to avoid a nested savepoint
+                super(TillClosure, superseded).save(using=kwargs.get('using'))
         if new_obj:
             self.identity = self.pk
-            self.save(duplicate=False)
+            super(TillClosure, self).save(update_fields=['identity'],
+                                          using=kwargs.get('using'))
+        if duplicate:
+            field_names = [f.attname for f in self._meta.concrete_fields]
+            self._loaded_values = (field_names, self._snapshot(
+                [getattr(self, name) for name in field_names]))
+
+    def versions(self):
+        """
+        Returns every version of this closure, oldest first, rebuilding any
+        stored as TillClosureDeltas. Should be called on the current version;
+        the result is cached until the closure is next saved.
+        """
+        using = self._state.db
+        field_names = [f.attname for f in self._meta.concrete_fields]
+        key = 'cashup:tillclosure-versions:{}:{}'.format(
+            self.identity, self.version_number)
+        rows = cache.get(key)
+        if rows is None:
+            rows = [[getattr(version, name) for name in field_names]
+                    for version in self._build_versions()]
+            timeout = getattr(settings, 'CASHUP_AUDIT_VERSIONS_TIMEOUT', 3600)
+            cache.set(key, rows, timeout)
+        return [TillClosure.from_db(using, field_names, row) for row in rows]
+
+    def _build_versions(self):
+        using = self._state.db
+        field_names = [f.attname for f in self._meta.concrete_fields]
+        def full_copies(queryset, archived):
+            return queryset.using(using).filter(identity=self.identity).annotate(
+                archived=models.Value(archived, models.BooleanField())
+            ).order_by().values_list(*field_names + ['archived'])
+        versions = {}
+        for row in full_copies(
+                TillClosure.audit_trail.exclude(pk=self.pk), False).union(
+                full_copies(ArchivedTillClosure.objects, True), all=True):
+            version = TillClosure.from_db(using, field_names, row[:-1])
+            if row[-1]:
+                # archived ids aren't TillClosure pks
+                version.pk = None
+            versions[version.version_number] = version
+        versions[self.version_number] = self
+        deltas = TillClosureDelta.objects.using(using).filter(
+            identity=self.identity).order_by('-version_number')
+        for delta in deltas:
+            next_version = versions.get(delta.version_number + 1)
+            if delta.version_number not in versions and next_version:
+                versions[delta.version_number] = delta.apply(next_version)
+        return [versions[number] for number in sorted(versions)]
 
     def __str__(self):
         return '{0} till closure at {1:%H:%M} on {1:%d/%m/%Y}'.format(
@@ -225,6 +360,138 @@ class TillClosure(models.Model):
     class Meta:
         get_latest_by = 'close_time'
         ordering = ['-close_time', 'version_number']
+        unique_together = ('identity', 'version_number')
+        indexes = [
+            models.Index(fields=['outlet', 'close_time'],
+                         name='cashup_till_outlet_time_idx'),
+            models.Index(fields=['closed_by', 'close_time'],
+                         name='cashup_till_closer_time_idx'),
+        ]
+
+DENOMINATION_FIELDS = tuple(f for f in TillClosure._meta.fields
+                            if isinstance(f, DenominationCountField))
+DENOMINATIONS = operator.attrgetter(*(f.attname for f in DENOMINATION_FIELDS))
+DENOMINATION_PENCE_VALUES = tuple(f.pence_value for f in DENOMINATION_FIELDS)
+VERSION_FIELDS = ('id', 'identity', 'version_number', 'version_created_time',
+                  'version_superseded_time', 'updated_by_id')
+DELTA_FIELDS = tuple(f for f in TillClosure._meta.concrete_fields
+                     if f.attname not in VERSION_FIELDS)
+
+
+class ArchivedTillClosure(AbstractTillClosure):
+    """
+    A superseded TillClosure version moved out of the TillClosure table so
+    that queries for current versions needn't skip over history. Written in
+    place of a full copy when the CASHUP_ARCHIVE_SUPERSEDED setting is True,
+    or by the archive_tillclosures command.
+    """
+    @classmethod
+    def from_version(cls, version):
+        values = {f.attname: getattr(version, f.attname)
+                  for f in cls._meta.concrete_fields}
+        values['id'] = None
+        return cls(**values)
+
+    def __str__(self):
+        return 'Archived till closure {} version {}'.format(
+            self.identity, self.version_number)
+
+    class Meta:
+        unique_together = ('identity', 'version_number')
+
+
+class TillClosureDelta(models.Model):
+    """
+    A superseded TillClosure version stored as only the fields which differ
+    from the version after it. Written in place of a full copy when the
+    CASHUP_AUDIT_DELTAS setting is True.
+    """
+    identity = models.PositiveIntegerField()
+    version_number = models.PositiveIntegerField()
+    version_created_time = models.DateTimeField()
+    version_superseded_time = models.DateTimeField()
+    updated_by = models.ForeignKey(Personnel, null=True, blank=True,
+        related_name='+', on_delete=models.PROTECT)
+    changes = models.TextField()
+
+    @classmethod
+    def between(cls, version, next_version):
+        """
+        Returns an unsaved delta from which `version` can be rebuilt given
+        `next_version`.
+        """
+        changes = {}
+        for field in DELTA_FIELDS:
+            value = field.get_prep_value(getattr(version, field.attname))
+            if value != field.get_prep_value(
+                    getattr(next_version, field.attname)):
+                # DjangoJSONEncoder drops microseconds past milliseconds
+                if isinstance(value, (datetime.datetime, datetime.time)):
+                    value = value.isoformat()
+                changes[field.attname] = value
+        return cls(identity=version.identity,
+                   version_number=version.version_number,
+                   version_created_time=version.version_created_time,
+                   version_superseded_time=version.version_superseded_time,
+                   updated_by_id=version.updated_by_id,
+                   changes=json.dumps(changes, cls=DjangoJSONEncoder))
+
+    def apply(self, next_version):
+        """
+        Returns the TillClosure version this delta was taken from. It is a
+        read-only copy for display and has no pk.
+        """
+        values = {f.attname: getattr(next_version, f.attname)
+                  for f in TillClosure._meta.concrete_fields}
+        fields = {f.attname: f for f in DELTA_FIELDS}
+        for name, value in json.loads(self.changes).items():
+            values[name] = fields[name].to_python(value)
+        values.update(id=None, identity=self.identity,
+                      version_number=self.version_number,
+                      version_created_time=self.version_created_time,
+                      version_superseded_time=self.version_superseded_time,
+                      updated_by_id=self.updated_by_id)
+        field_names = [f.attname for f in TillClosure._meta.concrete_fields]
+        return TillClosure.from_db(self._state.db, field_names,
+                                   [values[name] for name in field_names])
+
+    def __str__(self):
+        return 'Till closure {} version {}'.format(
+            self.identity, self.version_number)
+
+    class Meta:
+        unique_together = ('identity', 'version_number')
+
+
+class OutletDailyTotal(models.Model):
+    """
+    Totals of an Outlet's current TillClosures for one day, kept up to date
+    as closures are saved so reports needn't scan every closure.
+    """
+    outlet = models.ForeignKey(Outlet, related_name='daily_totals',
+        on_delete=models.CASCADE)
+    date = models.DateField()
+    closures = models.IntegerField(default=0)
+    cash_takings = models.DecimalField(max_digits=14, decimal_places=2,
+        default=Decimal('0.00'))
+    card_takings = models.DecimalField(max_digits=14, decimal_places=2,
+        default=Decimal('0.00'))
+    total_takings = models.DecimalField(max_digits=14, decimal_places=2,
+        default=Decimal('0.00'))
+    till_difference = models.DecimalField(max_digits=14, decimal_places=2,
+        default=Decimal('0.00'))
+    to_bank = models.DecimalField(max_digits=14, decimal_places=2,
+        default=Decimal('0.00'))
+
+    objects = DailyTotalManager()
+
+    def __str__(self):
+        return '{} totals for {:%d/%m/%Y}'.format(self.outlet.name, self.date)
+
+    class Meta:
+        ordering = ['date']
+        unique_together = ('outlet', 'date')
+
 
 class NotesHelpText(models.Model):
     text = models.CharField(max_length=128, unique=True)
@@ -0,0 +1,96 @@
+import base64
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorPage(object):
+    """
+    A page of results from `cursor_paginate`, with opaque cursors for the
+    pages either side of it.
+    Unlike Django's Page no count is needed, so it has no page numbers.
+    """
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def encode_cursor(ordering, reverse, obj, field, tie_breaker):
+    value = getattr(obj, field.attname)
+    value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+    data = [ordering, reverse, value, getattr(obj, tie_breaker)]
+    return base64.urlsafe_b64encode(
+        json.dumps(data).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, ordering, field):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)).decode())
+        cursor_ordering, reverse, value, tie_value = data
+        value = field.to_python(value)
+    except Exception:
+        raise InvalidCursor
+    if cursor_ordering != ordering:
+        raise InvalidCursor
+    return bool(reverse), value, tie_value
+
+def cursor_paginate(queryset, ordering, per_page, cursor=None,
+                    tie_breaker='identity'):
+    """
+    Returns a CursorPage of `queryset` ordered by `ordering` (a field name,
+    optionally prefixed with '-') then `tie_breaker` in the same direction.
+    Each page is found by seeking past the last row of the one before it, so
+    later pages cost the same as the first and no COUNT query is needed.
+    Raises InvalidCursor if `cursor` wasn't created for this ordering.
+    """
+    descending = ordering.startswith('-')
+    name = ordering.lstrip('-')
+    field = queryset.model._meta.get_field(name)
+    reverse = False
+    if cursor:
+        reverse, value, tie_value = decode_cursor(cursor, ordering, field)
+        # walking backwards swaps which side of the cursor we want
+        lookup = 'lt' if descending != reverse else 'gt'
+        queryset = queryset.filter(
+            Q(**{'{}__{}'.format(name, lookup): value}) |
+            Q(**{name: value,
+                 '{}__{}'.format(tie_breaker, lookup): tie_value}))
+    if descending != reverse:
+        order = ['-' + name, '-' + tie_breaker]
+    else:
+        order = [name, tie_breaker]
+    rows = list(queryset.order_by(*order)[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+
+    next_cursor = previous_cursor = None
+    if rows:
+        if has_more or reverse:
+            next_cursor = encode_cursor(
+                ordering, False, rows[-1], field, tie_breaker)
+        if cursor and (has_more or not reverse):
+            previous_cursor = encode_cursor(
+                ordering, True, rows[0], field, tie_breaker)
+    return CursorPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,95 @@
+"""
+Routes the reads of reporting views to a read replica.
+
+To use it, add the replica to DATABASES and name it in the
+CASHUP_REPLICA_DATABASE setting. Then add `cashup.routers.ReplicaRouter` to
+DATABASE_ROUTERS, last as it sends every write to the default database, and
+`cashup.routers.ReplicaRoutingMiddleware` to MIDDLEWARE after the
+authentication middleware. Views with `replica_reads = True` (see
+ReplicaReadMixin) then read cashup's tables from the replica for GET and HEAD
+requests. Other reads and all writes go to the default database.
+
+A client which has just written to cashup's tables reads from the default
+database for CASHUP_REPLICA_STICKY_SECONDS afterwards, so users don't see
+stale pages while the replica catches up. This is remembered in a signed
+cookie, so it holds whichever process serves the next request.
+"""
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = 'cashup_primary'
+
+_state = threading.local()
+
+
+def replica_alias():
+    return getattr(settings, 'CASHUP_REPLICA_DATABASE', None)
+
+def sticky_seconds():
+    return getattr(settings, 'CASHUP_REPLICA_STICKY_SECONDS', 15)
+
+
+class ReplicaReadMixin(object):
+    """Marks a view whose GET requests may be answered from the replica."""
+    replica_reads = True
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        # only cashup's own tables, so sessions and users are always read
+        # as they were just written
+        if model._meta.app_label == 'cashup' and \
+                getattr(_state, 'use_replica', False) and \
+                not getattr(_state, 'wrote', False):
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == 'cashup':
+            _state.wrote = True
+        # explicitly, as otherwise an instance read from the replica would
+        # be saved back to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # the replica is migrated by replication
+        if db == replica_alias():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.use_replica = _state.wrote = False
+        try:
+            response = self.get_response(request)
+            if _state.wrote:
+                response.set_signed_cookie(
+                    STICKY_COOKIE, '1', salt=STICKY_COOKIE,
+                    max_age=sticky_seconds(), httponly=True)
+        finally:
+            _state.use_replica = _state.wrote = False
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if (replica_alias() and request.method in ('GET', 'HEAD') and
+                getattr(view_class, 'replica_reads', False) and
+                not self.is_sticky(request)):
+            _state.use_replica = True
+
+    def is_sticky(self, request):
+        return request.get_signed_cookie(
+            STICKY_COOKIE, default=None, salt=STICKY_COOKIE,
+            max_age=sticky_seconds()) == '1'
@@ -1,8 +1,45 @@
 import rules
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
+from .models import StaffPosition
+from .signals import staff_positions_changed
 from .utils import in_editable_period
 
 
+# Memoized membership lookups
+
+_staff_positions_generation = 0
+
+def staff_positions(user):
+    """
+    Returns a dict mapping Outlet pk to an `(is_manager, is_staff)` tuple for
+    each of the user's StaffPositions.
+    The dict is memoized on the user object (i.e. for the duration of a
+    request) so outlet predicates can be answered without further queries.
+    """
+    memo = getattr(user, '_cashup_staff_positions', None)
+    if memo is None or memo[0] != _staff_positions_generation:
+        positions = StaffPosition.objects.filter(
+            personnel_id=user.profile.pk).values_list(
+                'outlet_id', 'is_manager', 'is_staff')
+        memo = (_staff_positions_generation, {
+            outlet_id: (is_manager, is_staff)
+            for outlet_id, is_manager, is_staff in positions})
+        user._cashup_staff_positions = memo
+    return memo[1]
+
+@receiver(post_save, sender=StaffPosition)
+@receiver(post_delete, sender=StaffPosition)
+@receiver(staff_positions_changed, sender=StaffPosition)
+def invalidate_staff_positions(sender, **kwargs):
+    global _staff_positions_generation
+    _staff_positions_generation += 1
+
+def owns_business(user, business_id):
+    return user.profile.is_owner and user.profile.business_id == business_id
+
+
 # Business rules
 
 @rules.predicate
@@ -11,7 +48,7 @@ def is_a_business_owner(user):
 
 @rules.predicate
 def is_business_owner(user, business):
-    return user.profile.business == business and user.profile.is_owner
+    return owns_business(user, business.pk)
 
 rules.add_perm('cashup.view_business', is_business_owner)
 rules.add_perm('cashup.change_business', is_business_owner)
@@ -20,7 +57,7 @@ rules.add_perm('cashup.change_business', is_business_owner)
 
 @rules.predicate
 def is_personnel_business_owner(user, personnel):
-    return is_business_owner(user, personnel.business)
+    return owns_business(user, personnel.business_id)
 
 @rules.predicate
 def is_personnel(user, personnel):
@@ -46,15 +83,15 @@ rules.add_perm('cashup.view_personnel_tillclosure_audit_trail',
 
 @rules.predicate
 def is_outlet_owner(user, outlet):
-    return is_business_owner(user, outlet.business)
+    return owns_business(user, outlet.business_id)
 
 @rules.predicate
 def is_outlet_manager(user, outlet):
-    return outlet.staff.filter(personnel=user.profile, is_manager=True).exists()
+    return staff_positions(user).get(outlet.pk, (False, False))[0]
 
 @rules.predicate
 def is_outlet_staff(user, outlet):
-    return outlet.staff.filter(personnel=user.profile, is_staff=True).exists()
+    return staff_positions(user).get(outlet.pk, (False, False))[1]
 
 rules.add_perm('cashup.change_outlet', is_outlet_owner | is_outlet_manager)
 rules.add_perm('cashup.view_outlet', is_outlet_owner | is_outlet_staff)
@@ -66,7 +103,7 @@ rules.add_perm('cashup.view_outlet_tillclosure_audit_trail',
 
 @rules.predicate
 def was_closed_by(user, tillcashup):
-    return tillcashup.closed_by.user == user
+    return tillcashup.closed_by_id == user.profile.pk
 
 @rules.predicate
 def is_editable(user, tillcashup):
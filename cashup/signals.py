@@ -0,0 +1,83 @@
+import json
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from .models import (Business, Outlet, StaffPosition, Personnel, TillClosure,
+                     ArchivedTillClosure, TillClosureDelta, OutletDailyTotal,
+                     NotesHelpText)
+from .context_processors import invalidate_outlet_menus
+from .templatetags.notes_help import invalidate_help_text_ids
+from .analytics import invalidate_closure_history
+from .views import invalidate_audit_pages
+
+# sent after StaffPositions are changed in bulk, which bypasses post_save
+staff_positions_changed = Signal(providing_args=['outlet'])
+# sent after TillClosures are created in bulk, likewise
+tillclosures_created = Signal(providing_args=['closures'])
+
+
+@receiver(post_save, sender=Outlet)
+@receiver(post_delete, sender=Outlet)
+@receiver(post_save, sender=StaffPosition)
+@receiver(post_delete, sender=StaffPosition)
+@receiver(staff_positions_changed, sender=StaffPosition)
+@receiver(post_save, sender=Personnel)
+@receiver(post_delete, sender=Personnel)
+def outlet_menu_changed(sender, **kwargs):
+    invalidate_outlet_menus()
+
+
+@receiver(post_save, sender=Business)
+@receiver(post_delete, sender=Business)
+@receiver(post_save, sender=Outlet)
+@receiver(post_delete, sender=Outlet)
+@receiver(post_save, sender=Personnel)
+@receiver(post_delete, sender=Personnel)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def names_changed(sender, update_fields=None, **kwargs):
+    # logging in saves the user's last_login alone, which no page shows
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        invalidate_audit_pages()
+
+
+@receiver(post_save, sender=NotesHelpText)
+@receiver(post_delete, sender=NotesHelpText)
+def notes_help_changed(sender, **kwargs):
+    invalidate_help_text_ids()
+
+
+@receiver(post_save, sender=TillClosure)
+@receiver(post_delete, sender=TillClosure)
+@receiver(post_save, sender=ArchivedTillClosure)
+@receiver(tillclosures_created, sender=TillClosure)
+def closure_history_changed(sender, instance=None, closures=None, **kwargs):
+    # superseded versions are saved too, so an edit which moves a closure
+    # to another outlet or person invalidates both
+    closures = [instance] if closures is None else closures
+    invalidate_closure_history(
+        outlets=[closure.outlet_id for closure in closures],
+        personnel=[closure.closed_by_id for closure in closures])
+
+
+@receiver(post_save, sender=TillClosureDelta)
+def closure_delta_saved(sender, instance, **kwargs):
+    # a delta holds the superseded values of only the fields which changed
+    changes = json.loads(instance.changes)
+    invalidate_closure_history(
+        outlets=[changes['outlet_id']] if 'outlet_id' in changes else [],
+        personnel=[changes['closed_by_id']] if 'closed_by_id' in changes
+            else [])
+
+
+@receiver(post_delete, sender=TillClosure)
+def tillclosure_deleted(sender, instance, using, **kwargs):
+    if instance.version_superseded_time is None:
+        OutletDailyTotal.objects.db_manager(using).record(removed=[instance])
+    # deltas are keyed on identity rather than a ForeignKey, so they go with
+    # the current row; compacting only deletes superseded rows
+    if instance.pk == instance.identity:
+        TillClosureDelta.objects.using(using).filter(
+            identity=instance.identity).delete()
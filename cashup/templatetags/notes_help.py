@@ -1,11 +1,45 @@
+import random
+
 from django import template
+from django.conf import settings
+from django.core.cache import cache
 
 from cashup.models import NotesHelpText
+from cashup.utils import cache_version, bump_cache_version
 
 
 register = template.Library()
 
 
+def invalidate_help_text_ids():
+    bump_cache_version('cashup:notes-help')
+
+def help_text_ids():
+    """
+    Returns the list of NotesHelpText pks, cached until a NotesHelpText is
+    saved or deleted.
+    """
+    key = 'cashup:notes-help:{}'.format(cache_version('cashup:notes-help'))
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(NotesHelpText.objects.values_list('pk', flat=True))
+        timeout = getattr(settings, 'CASHUP_NOTES_HELP_TIMEOUT', 3600)
+        cache.set(key, ids, timeout)
+    return ids
+
+
 @register.simple_tag
 def random_help_text():
-    return NotesHelpText.objects.order_by('?').first()
+    ids = help_text_ids()
+    if not ids:
+        return None
+    help_text = NotesHelpText.objects.filter(pk=random.choice(ids)).first()
+    if help_text is None:
+        # deleted without a signal, e.g. by QuerySet.delete(), so the list
+        # is stale; fetch it again and choose once more
+        invalidate_help_text_ids()
+        ids = help_text_ids()
+        if ids:
+            help_text = NotesHelpText.objects.filter(
+                pk=random.choice(ids)).first()
+    return help_text
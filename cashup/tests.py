@@ -1,3 +1,1262 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, models, IntegrityError
+from django.db.models import F
+from django.test import (TestCase, TransactionTestCase, modify_settings,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import analytics
+from .benchmarks import cashup_urls, find_regressions
+from .context_processors import outlets_for_menu
+from .managers import TillClosureQuerySet
+from .modelfields import DenominationCount
+from .models import (Business, Outlet, Personnel, StaffPosition, TillClosure,
+                     TillClosureDelta, ArchivedTillClosure, NotesHelpText,
+                     OutletDailyTotal, DENOMINATION_FIELDS)
+from .routers import STICKY_COOKIE
+from .templatetags.notes_help import random_help_text
+from .views import (OutletTillClosureListView, TillClosureCreateView,
+                    TillClosureUpdateView)
+
+
+def create_personnel(business, username, **kwargs):
+    user = get_user_model().objects.create_user(username, password='password')
+    return Personnel.objects.create(user=user, business=business, **kwargs)
+
+def create_outlet(business, name, staff=()):
+    outlet = Outlet.objects.create(business=business, name=name,
+                                   default_float=Decimal('50.00'))
+    for personnel in staff:
+        StaffPosition.objects.create(personnel=personnel, outlet=outlet,
+                                     is_staff=True)
+    return outlet
+
+def create_tillclosure(outlet, closed_by, **kwargs):
+    fields = {'cash_takings': Decimal('100.00'),
+              'card_takings': Decimal('50.00'),
+              'till_float': Decimal('50.00'),
+              'note_20GBP': 5, 'note_10GBP': 5}
+    fields.update(kwargs)
+    tillclosure = TillClosure(outlet=outlet, closed_by=closed_by, **fields)
+    tillclosure.save()
+    return tillclosure
+
+
+class CashupTestMixin(object):
+    def setUp(self):
+        cache.clear()
+        self.business = Business.objects.create(name='Business')
+        self.owner = create_personnel(self.business, 'owner', is_owner=True)
+        self.staff = create_personnel(self.business, 'staff')
+        self.outlet = create_outlet(self.business, 'Shop', staff=[self.staff])
+
+    def login(self, personnel):
+        self.client.login(username=personnel.user.username,
+                          password='password')
+
+
+class CashupTestCase(CashupTestMixin, TestCase):
+    pass
+
+
+class BusinessDashboardViewTest(CashupTestCase):
+    url = reverse('cashup_business_dashboard')
+
+    def test_totals_per_outlet(self):
+        create_tillclosure(self.outlet, self.staff)
+        create_tillclosure(self.outlet, self.staff,
+                           cash_takings=Decimal('10.00'))
+        other = create_outlet(self.business, 'Other', staff=[self.staff])
+        self.login(self.owner)
+        response = self.client.get(self.url)
+        totals = {o.name: o for o in response.context['outlet_totals']}
+        self.assertEqual(totals['Shop'].closures, 2)
+        self.assertEqual(totals['Shop'].cash_takings, Decimal('110.00'))
+        self.assertEqual(totals['Shop'].total_takings, Decimal('210.00'))
+        self.assertEqual(totals[other.name].closures, 0)
+        self.assertEqual(totals[other.name].total_takings, Decimal('0.00'))
+        self.assertEqual(response.context['totals']['closures'], 2)
+
+    def test_date_range(self):
+        create_tillclosure(self.outlet, self.staff,
+            close_time=timezone.now() - datetime.timedelta(days=60))
+        self.login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['totals']['closures'], 0)
+        start = timezone.localtime(timezone.now()).date() - \
+            datetime.timedelta(days=90)
+        response = self.client.get(self.url, {'from': start.isoformat()})
+        self.assertEqual(response.context['totals']['closures'], 1)
+
+    def test_totals_only_read_days_in_range(self):
+        start = datetime.date(2017, 6, 1)
+        for days in (-1, 0, 6, 7):
+            OutletDailyTotal.objects.create(
+                outlet=self.outlet, date=start + datetime.timedelta(days),
+                closures=1, cash_takings=Decimal(days + 1))
+        outlets = Outlet.objects.with_totals(
+            start, start + datetime.timedelta(6))
+        self.assertNotIn('JOIN', str(outlets.query))
+        outlet = outlets.get()
+        self.assertEqual((outlet.closures, outlet.cash_takings),
+                         (2, Decimal('8.00')))
+
+    def test_query_count_constant_in_outlets(self):
+        self.login(self.owner)
+        create_tillclosure(self.outlet, self.staff)
+        self.client.get(self.url)  # fill the outlet menu cache
+        with self.assertNumQueries(5):
+            self.client.get(self.url)
+        for i in range(5):
+            outlet = create_outlet(self.business, 'Outlet {}'.format(i))
+            create_tillclosure(outlet, self.owner)
+        self.client.get(self.url)
+        with self.assertNumQueries(5):
+            self.client.get(self.url)
+
+    def test_requires_owner(self):
+        self.login(self.staff)
+        response = self.client.get(self.url)
+        self.assertNotEqual(response.status_code, 200)
+
+
+class OutletDailyTotalTest(CashupTestCase):
+    def assertMatchesRebuild(self):
+        fields = ['outlet_id', 'date', 'closures'] + list(
+            OutletDailyTotal.objects.all().amount_fields)
+        totals = list(OutletDailyTotal.objects.order_by(
+            'outlet_id', 'date').values_list(*fields))
+        OutletDailyTotal.objects.rebuild()
+        self.assertEqual(totals, list(OutletDailyTotal.objects.order_by(
+            'outlet_id', 'date').values_list(*fields)))
+
+    def test_matches_rebuild(self):
+        other = create_outlet(self.business, 'Other')
+        yesterday = timezone.now() - datetime.timedelta(days=1)
+        first = create_tillclosure(self.outlet, self.staff)
+        second = create_tillclosure(self.outlet, self.staff,
+                                    close_time=yesterday)
+        self.assertMatchesRebuild()
+
+        first.cash_takings = Decimal('80.00')
+        first.save()
+        self.assertMatchesRebuild()
+
+        second.outlet = other
+        second.save()
+        self.assertMatchesRebuild()
+        self.assertFalse(self.outlet.daily_totals.filter(
+            date=timezone.localtime(yesterday).date()).exists())
+
+        first.delete()
+        self.assertMatchesRebuild()
+        self.assertFalse(self.outlet.daily_totals.exists())
+
+
+class OutletTillClosureListViewTest(CashupTestCase):
+    def setUp(self):
+        super(OutletTillClosureListViewTest, self).setUp()
+        self.url = reverse('cashup_outlet_detail',
+                           kwargs={'slug': self.outlet.slug})
+
+    def test_date_range(self):
+        now = timezone.now()
+        recent = create_tillclosure(self.outlet, self.staff, close_time=now)
+        create_tillclosure(self.outlet, self.staff,
+                           close_time=now - datetime.timedelta(days=40))
+        today = timezone.localtime(now).date()
+        self.login(self.owner)
+        response = self.client.get(self.url, {
+            'from': (today - datetime.timedelta(days=7)).isoformat(),
+            'to': today.isoformat()})
+        self.assertEqual(list(response.context['object_list']), [recent])
+        self.assertEqual(response.context['totals']['total_takings'],
+                         recent.total_takings)
+
+    def test_loads_only_list_columns(self):
+        create_tillclosure(self.outlet, self.staff, notes='Not needed')
+        self.login(self.owner)
+        response = self.client.get(self.url)
+        tillclosure = response.context['object_list'][0]
+        loaded = {f.attname for f in TillClosure._meta.concrete_fields} - \
+            tillclosure.get_deferred_fields()
+        self.assertEqual(loaded, {'id', 'identity', 'close_time',
+                                  'total_takings', 'till_difference'})
+
+    def test_query_count_constant_in_rows(self):
+        self.login(self.owner)
+        create_tillclosure(self.outlet, self.staff)
+        self.client.get(self.url)  # fill the outlet menu cache
+        with self.assertNumQueries(9):
+            self.client.get(self.url)
+        for i in range(5):
+            create_tillclosure(self.outlet, self.staff)
+        self.client.get(self.url)
+        with self.assertNumQueries(9):
+            self.client.get(self.url)
+
+
+class TillClosureListPaginationTest(CashupTestCase):
+    def setUp(self):
+        super(TillClosureListPaginationTest, self).setUp()
+        now = timezone.now()
+        for i in range(60):
+            create_tillclosure(self.outlet, self.staff,
+                close_time=now - datetime.timedelta(hours=i * 7 % 60),
+                cash_takings=Decimal(100 + i * 13 % 60), coin_1p=i % 7)
+        TillClosure.audit_trail.filter(pk__in=TillClosure.audit_trail.order_by(
+            'pk').values_list('pk', flat=True)[::12]).update(
+            version_superseded_time=now)
+        self.url = reverse('cashup_outlet_detail',
+                           kwargs={'slug': self.outlet.slug})
+        self.login(self.owner)
+
+    def identities(self, response):
+        return [tillclosure.identity
+                for tillclosure in response.context['object_list']]
+
+    def assert_pages(self, order_by, showdeleted):
+        params = {'order-by': order_by}
+        closures = TillClosure.audit_trail.filter(pk=F('identity'))
+        if showdeleted:
+            params['showdeleted'] = '1'
+        else:
+            closures = closures.filter(version_superseded_time=None)
+        field = OutletTillClosureListView.order_dict[order_by]
+        expected = list(closures.order_by(
+            field, field.replace(field.lstrip('-'), 'identity')).values_list(
+                'identity', flat=True))
+
+        first = self.client.get(self.url, params)
+        second = self.client.get(self.url + first.context['next_page_url'])
+        self.assertEqual(self.identities(first) + self.identities(second),
+                         expected)
+        self.assertFalse(second.context['page_obj'].has_next())
+        back = self.client.get(self.url + second.context['previous_page_url'])
+        self.assertEqual(self.identities(back), self.identities(first))
+        self.assertFalse(back.context['page_obj'].has_previous())
+
+    def test_pages_each_ordering(self):
+        for order_by in OutletTillClosureListView.order_dict:
+            for showdeleted in (False, True):
+                with self.subTest(order_by=order_by, showdeleted=showdeleted):
+                    self.assert_pages(order_by, showdeleted)
+
+    def test_page_links_keep_filters(self):
+        today = timezone.localtime(timezone.now()).date()
+        params = {'order-by': 'takings', 'showdeleted': '1',
+                  'from': (today - datetime.timedelta(days=7)).isoformat()}
+        response = self.client.get(self.url, params)
+        url = response.context['next_page_url']
+        for key, value in params.items():
+            self.assertIn('{}={}'.format(key, value), url)
+        self.assertIn('cursor=', url)
+        self.assertContains(response, url.replace('&', '&amp;'))
+
+    def test_mismatched_cursor_shows_first_page(self):
+        first = self.client.get(self.url, {'order-by': 'takings'})
+        response = self.client.get(
+            self.url + first.context['next_page_url'].replace(
+                'order-by=takings', 'order-by=-difference'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.identities(response),
+            self.identities(self.client.get(
+                self.url, {'order-by': '-difference'})))
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+
+# rendered audit pages aren't kept, so their queries are counted
+@override_settings(CASHUP_AUDIT_PAGE_TIMEOUT=0)
+class TillClosureDetailViewsTest(CashupTestCase):
+    def setUp(self):
+        super(TillClosureDetailViewsTest, self).setUp()
+        self.tillclosure = create_tillclosure(self.outlet, self.staff)
+        for updated_by in (self.staff, self.owner):
+            self.tillclosure.updated_by = updated_by
+            self.tillclosure.save()
+        self.login(self.owner)
+
+    def assertNumQueriesForView(self, url, num):
+        self.client.get(url)  # fill the outlet menu cache
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_queries(self):
+        self.assertNumQueriesForView(self.tillclosure.get_absolute_url(), 6)
+
+    def test_audit_trail_list_queries(self):
+        self.assertNumQueriesForView(self.tillclosure.get_audit_list_url(), 7)
+
+    def test_audit_trail_detail_queries(self):
+        self.assertNumQueriesForView(self.tillclosure.get_audit_url(), 6)
+
+
+class TillClosureVersionTest(CashupTestCase):
+    def assert_count_edited_in_place(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        tillclosure = TillClosure.objects.get(pk=tillclosure.pk)
+        for count in (7, 9):
+            tillclosure.coin_1p.count = count
+            tillclosure.save()
+        versions = tillclosure.versions()
+        self.assertEqual([v.coin_1p.count for v in versions], [0, 7, 9])
+        self.assertEqual(versions[0].till_total, Decimal('150.00'))
+
+    def test_count_edited_in_place(self):
+        self.assert_count_edited_in_place()
+
+    @override_settings(CASHUP_AUDIT_DELTAS=True)
+    def test_count_edited_in_place_with_deltas(self):
+        self.assert_count_edited_in_place()
+
+    def test_refresh_from_db(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        TillClosure.objects.filter(pk=tillclosure.pk).update(notes='Edited')
+        tillclosure.refresh_from_db()
+        tillclosure.notes = 'Edited again'
+        tillclosure.save()
+        self.assertEqual([v.notes for v in tillclosure.versions()],
+                         ['Edited', 'Edited again'])
+
+    def test_version_numbers_unique(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        copy = TillClosure.objects.get(pk=tillclosure.pk)
+        copy.pk = None
+        with self.assertRaises(IntegrityError):
+            # Model.save inserts the row as it is, without versioning
+            models.Model.save(copy)
+
+    def test_new_closures_get_own_identity(self):
+        first = create_tillclosure(self.outlet, self.staff)
+        second = create_tillclosure(self.outlet, self.staff)
+        self.assertEqual((first.identity, second.identity),
+                         (first.pk, second.pk))
+        self.assertFalse(TillClosure.audit_trail.filter(
+            identity=None).exists())
+
+    def test_concurrent_edit_conflicts(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        stale = TillClosure.objects.get(pk=tillclosure.pk)
+        tillclosure = TillClosure.objects.get(pk=tillclosure.pk)
+        tillclosure.notes = 'First'
+        tillclosure.save()
+        stale.notes = 'Second'
+        with self.assertRaises(IntegrityError):
+            stale.save()
+        self.assertEqual([v.notes for v in tillclosure.versions()],
+                         ['', 'First'])
+
+    def test_update_view_reports_conflict(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        stale = TillClosure.objects.get(pk=tillclosure.pk)
+        tillclosure = TillClosure.objects.get(pk=tillclosure.pk)
+        tillclosure.notes = 'First'
+        tillclosure.save()
+        data = {name: getattr(stale, name)
+                for name in TillClosureUpdateView.fields}
+        data.update({name: data[name].count for name in data
+                     if isinstance(data[name], DenominationCount)},
+                    close_time=timezone.localtime(stale.close_time).strftime(
+                        '%Y-%m-%d %H:%M'),
+                    notes='Second')
+        self.login(self.owner)
+        with mock.patch.object(TillClosureUpdateView, 'get_object',
+                               return_value=stale):
+            response = self.client.post(reverse(
+                'cashup_closure_update', kwargs={'pk': stale.pk}), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(TillClosureUpdateView.conflict_message,
+                      response.context['form'].non_field_errors())
+        self.assertEqual(TillClosure.objects.get(pk=stale.pk).notes, 'First')
+
+    def test_create_view_reports_conflict(self):
+        data = dict.fromkeys((f.name for f in DENOMINATION_FIELDS), 0)
+        data.update(close_time='2017-01-10 20:00', cash_takings='100.00',
+                    card_takings='50.00', till_float='50.00')
+        self.login(self.staff)
+        with mock.patch.object(TillClosure, 'save',
+                               side_effect=IntegrityError):
+            response = self.client.post(reverse(
+                'cashup_closure_create', kwargs={'slug': self.outlet.slug}),
+                data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(TillClosureCreateView.conflict_message,
+                      response.context['form'].non_field_errors())
+
+
+@override_settings(CASHUP_AUDIT_DELTAS=True)
+class TillClosureDeltaTest(CashupTestCase):
+    def setUp(self):
+        super(TillClosureDeltaTest, self).setUp()
+        self.tillclosure = create_tillclosure(self.outlet, self.staff,
+                                              notes='First')
+        self.tillclosure.notes = 'Second'
+        self.tillclosure.updated_by = self.staff
+        self.tillclosure.save()
+        self.tillclosure.cash_takings = Decimal('90.00')
+        self.tillclosure.coin_1p = 3
+        self.tillclosure.updated_by = self.owner
+        self.tillclosure.save()
+
+    def test_stores_only_changed_fields(self):
+        self.assertEqual(TillClosure.audit_trail.count(), 1)
+        deltas = TillClosureDelta.objects.order_by('version_number')
+        self.assertEqual([json.loads(d.changes) for d in deltas], [
+            {'notes': 'First'},
+            {'cash_takings': '100.00', 'coin_1p': 0,
+             'till_total': '150.00', 'till_difference': '0.00',
+             'total_takings': '150.00'},
+        ])
+
+    def test_rebuilds_versions(self):
+        versions = self.tillclosure.versions()
+        self.assertEqual([v.version_number for v in versions], [1, 2, 3])
+        self.assertEqual([v.notes for v in versions],
+                         ['First', 'Second', 'Second'])
+        self.assertEqual(versions[1].cash_takings, Decimal('100.00'))
+        self.assertEqual(versions[1].coin_1p.count, 0)
+        self.assertEqual(versions[1].updated_by_id, self.staff.pk)
+
+    def test_audit_trail_detail(self):
+        self.login(self.owner)
+        response = self.client.get(reverse(
+            'cashup_closure_audit_trail_detail',
+            kwargs={'pk': self.tillclosure.pk, 'version': 1}))
+        self.assertEqual(response.context['object'].notes, 'First')
+
+    def test_keeps_full_precision_times(self):
+        close_time = self.tillclosure.close_time.replace(
+            microsecond=123456)
+        TillClosure.objects.filter(pk=self.tillclosure.pk).update(
+            close_time=close_time)
+        tillclosure = TillClosure.objects.get(pk=self.tillclosure.pk)
+        tillclosure.close_time = close_time.replace(microsecond=0)
+        tillclosure.save()
+        self.assertEqual(tillclosure.versions()[2].close_time, close_time)
+
+    def test_deleted_with_closure(self):
+        other = create_tillclosure(self.outlet, self.staff, notes='First')
+        other.notes = 'Second'
+        other.save()
+        self.tillclosure.delete()
+        self.assertEqual(
+            list(TillClosureDelta.objects.values_list('identity', flat=True)),
+            [other.identity])
+        self.outlet.delete()
+        self.assertFalse(TillClosureDelta.objects.exists())
+
+    @override_settings(CASHUP_AUDIT_DELTAS=False)
+    def test_compact_history(self):
+        create_tillclosure(self.outlet, self.staff).save()
+        before = [[v.notes, v.cash_takings, v.version_number] for v in
+                  TillClosure.audit_trail.get(pk=self.tillclosure.pk
+                  )._build_versions()]
+        self.assertEqual(TillClosure.audit_trail.compact_history(), 1)
+        self.assertEqual(TillClosure.audit_trail.count(), 2)
+        after = [[v.notes, v.cash_takings, v.version_number] for v in
+                 self.tillclosure._build_versions()]
+        self.assertEqual(before, after)
+
+
+class ArchivedTillClosureTest(CashupTestCase):
+    def setUp(self):
+        super(ArchivedTillClosureTest, self).setUp()
+        self.tillclosure = create_tillclosure(self.outlet, self.staff,
+                                              notes='First')
+        self.tillclosure.notes = 'Second'
+        self.tillclosure.save()
+
+    def assertVersions(self, notes):
+        tillclosure = TillClosure.objects.get(pk=self.tillclosure.pk)
+        self.assertEqual([v.notes for v in tillclosure._build_versions()],
+                         notes)
+
+    def test_archive_superseded(self):
+        self.assertEqual(TillClosure.audit_trail.archive_superseded(), 1)
+        self.assertEqual(TillClosure.audit_trail.count(), 1)
+        self.assertEqual(ArchivedTillClosure.objects.count(), 1)
+        self.assertVersions(['First', 'Second'])
+
+    @override_settings(CASHUP_ARCHIVE_SUPERSEDED=True)
+    def test_archives_on_save(self):
+        self.tillclosure.notes = 'Third'
+        self.tillclosure.save()
+        self.assertEqual(TillClosure.audit_trail.count(), 2)
+        self.assertEqual(ArchivedTillClosure.objects.get().notes, 'Second')
+        self.assertVersions(['First', 'Second', 'Third'])
+        self.login(self.owner)
+        response = self.client.get(reverse(
+            'cashup_closure_audit_trail_detail',
+            kwargs={'pk': self.tillclosure.pk, 'version': 2}))
+        self.assertEqual(response.context['object'].notes, 'Second')
+
+
+@override_settings(CASHUP_PROFILE_REQUESTS=True)
+@modify_settings(MIDDLEWARE={
+    'append': 'cashup.middleware.RequestProfileMiddleware'})
+
+
+class RequestProfileMiddlewareTest(CashupTestCase):
+    def test_server_timing(self):
+        self.login(self.owner)
+        url = reverse('cashup_outlet_detail', kwargs={'slug': self.outlet.slug})
+        with self.assertLogs('cashup.profile', 'INFO') as logs:
+            response = self.client.get(url)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries')
+        self.assertRegex(timing, r'rules;dur=[\d.]+;desc="[1-9]\d* checks"')
+        self.assertIn('view=cashup.views.OutletTillClosureListView',
+                      logs.output[0])
+
+    def test_streamed_response_reported_once_read(self):
+        create_tillclosure(self.outlet, self.staff)
+        self.login(self.owner)
+        url = reverse('cashup_outlet_export', kwargs={'slug': self.outlet.slug})
+        with self.assertLogs('cashup.profile', 'INFO') as logs:
+            response = self.client.get(url)
+            self.assertEqual(logs.records, [])
+            b''.join(response.streaming_content)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(len(logs.records), 1)
+        # the closures are exported while the response is read
+        queries = list(connection.queries_log)
+        self.assertTrue(any('"cashup_tillclosure"' in query['sql']
+                            for query in queries))
+        self.assertEqual(logs.records[0].queries, len(queries))
+
+    @override_settings(CASHUP_PROFILE_REQUESTS=False)
+    def test_disabled(self):
+        self.login(self.owner)
+        response = self.client.get(reverse('cashup_outlet_list'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class OutletStaffTest(CashupTestCase):
+    def setUp(self):
+        super(OutletStaffTest, self).setUp()
+        self.settings_url = reverse('cashup_outlet_settings',
+                                    kwargs={'slug': self.outlet.slug})
+        self.url = reverse('cashup_outlet_staff',
+                           kwargs={'slug': self.outlet.slug})
+        self.login(self.owner)
+
+    def test_settings_queries_constant_in_personnel(self):
+        self.client.get(self.settings_url)  # fill the outlet menu cache
+        with self.assertNumQueries(8):
+            self.client.get(self.settings_url)
+        for i in range(30):
+            create_personnel(self.business, 'person{}'.format(i))
+        self.client.get(self.settings_url)
+        with self.assertNumQueries(8):
+            response = self.client.get(self.settings_url)
+        self.assertEqual(len(response.context['staff_page']), 25)
+
+    def test_search(self):
+        create_personnel(self.business, 'findme')
+        response = self.client.get(self.settings_url, {'q': 'find'})
+        self.assertEqual([p.user.username for p, position
+                          in response.context['staff_page']], ['findme'])
+
+    def test_apply_changes(self):
+        manager = create_personnel(self.business, 'manager')
+        response = self.client.post(self.url, {
+            'personnel': [self.staff.pk, manager.pk],
+            'manager': [manager.pk],
+            'staff': [manager.pk],
+        })
+        self.assertRedirects(response, self.settings_url)
+        positions = StaffPosition.objects.filter(outlet=self.outlet)
+        self.assertEqual(
+            list(positions.values_list('personnel', 'is_manager', 'is_staff')),
+            [(manager.pk, True, True)])
+
+    def test_rejects_other_business(self):
+        other = create_personnel(Business.objects.create(name='Other'),
+                                 'other')
+        response = self.client.post(self.url, {
+            'personnel': [other.pk], 'staff': [other.pk]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StaffPosition.objects.filter(personnel=other).exists())
+
+
+class AuditTrailCacheTest(CashupTestCase):
+    def setUp(self):
+        super(AuditTrailCacheTest, self).setUp()
+        self.tillclosure = create_tillclosure(self.outlet, self.staff)
+        self.tillclosure.notes = 'Edited'
+        self.tillclosure.save()
+        self.login(self.owner)
+
+    def test_not_modified(self):
+        url = self.tillclosure.get_audit_list_url()
+        response = self.client.get(url)
+        self.assertTemplateUsed(response,
+                                'cashup/tillclosure_audit_trail_list.html')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_content(self):
+        url = reverse('cashup_closure_audit_trail_detail',
+                      kwargs={'pk': self.tillclosure.pk, 'version': 1})
+        first = self.client.get(url)
+        second = self.client.get(url)
+        self.assertEqual(second.templates, [])
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_new_version_changes_etag(self):
+        url = self.tillclosure.get_audit_list_url()
+        etag = self.client.get(url)['ETag']
+        self.tillclosure.notes = 'Edited again'
+        self.tillclosure.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['object_list']), 3)
+
+    def test_renamed_names_not_stale(self):
+        url = reverse('cashup_closure_audit_trail_detail',
+                      kwargs={'pk': self.tillclosure.pk, 'version': 1})
+        self.client.get(url)
+        user = self.staff.user
+        user.first_name = 'Renamed'
+        user.save()
+        self.business.name = 'Renamed business'
+        self.business.save()
+        content = self.client.get(url).content.decode()
+        self.assertIn('Renamed', self.staff.name)
+        self.assertIn(self.staff.name, content)
+        self.assertIn('Renamed business', content)
+
+    def test_login_keeps_etag(self):
+        url = self.tillclosure.get_audit_list_url()
+        etag = self.client.get(url)['ETag']
+        self.login(self.owner)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class NotesHelpTextTest(CashupTestCase):
+    def test_empty_table(self):
+        self.assertIsNone(random_help_text())
+        NotesHelpText.objects.create(text='Count twice')
+        self.assertEqual(random_help_text().text, 'Count twice')
+
+    def test_invalidated_on_delete(self):
+        first = NotesHelpText.objects.create(text='Count twice')
+        self.assertEqual(random_help_text(), first)
+        first.delete()
+        second = NotesHelpText.objects.create(text='Note any refunds')
+        with self.assertNumQueries(2):
+            self.assertEqual(random_help_text(), second)
+        with self.assertNumQueries(1):
+            self.assertEqual(random_help_text(), second)
+
+    def test_deleted_without_signal(self):
+        first = NotesHelpText.objects.create(text='Count twice')
+        random_help_text()
+        # e.g. by another process with its own cache, or in raw SQL
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE id = %s'.format(
+                NotesHelpText._meta.db_table), [first.pk])
+        self.assertIsNone(random_help_text())
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {} (text) VALUES (%s)'.format(
+                NotesHelpText._meta.db_table), ['Note any refunds'])
+        self.assertIsNone(random_help_text())
+        NotesHelpText.objects.create(text='Count twice')
+        NotesHelpText.objects.get(text='Count twice').delete()
+        self.assertEqual(random_help_text().text, 'Note any refunds')
+
+
+# Needs a second alias, named by CASHUP_REPLICA_DATABASE, which mirrors the
+# default database in tests; e.g. 'replica' with {'TEST': {'MIRROR':
+# 'default'}}.
+REPLICA = getattr(settings, 'CASHUP_REPLICA_DATABASE', 'replica')
+
+
+@skipUnless(settings.DATABASES.get(REPLICA, {}).get('TEST', {}).get(
+    'MIRROR') == 'default', 'No replica mirroring the default database')
+
+
+@override_settings(
+    CASHUP_REPLICA_DATABASE=REPLICA,
+    DATABASE_ROUTERS=['cashup.routers.ReplicaRouter'])
+
+
+@modify_settings(MIDDLEWARE={
+    'append': 'cashup.routers.ReplicaRoutingMiddleware'})
+
+
+class ReplicaRouterTest(CashupTestMixin, TransactionTestCase):
+    # the replica has its own connection, so it can only see data which
+    # has been committed
+
+    def setUp(self):
+        super(ReplicaRouterTest, self).setUp()
+        self.list_url = reverse('cashup_outlet_detail',
+                                kwargs={'slug': self.outlet.slug})
+        self.login(self.owner)
+
+    def cashup_queries(self, method, *args, **kwargs):
+        """
+        Makes a request with the test client and returns the number of
+        queries of cashup's tables run on the default and replica databases.
+        """
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections[REPLICA]) as replica:
+            getattr(self.client, method)(*args, **kwargs)
+        return tuple(
+            len([q for q in queries if 'cashup_' in q['sql']])
+            for queries in (default, replica))
+
+    def test_reporting_view_reads_from_replica(self):
+        default, replica = self.cashup_queries('get', self.list_url)
+        self.assertEqual(default, 0)
+        self.assertGreater(replica, 0)
+
+    def test_other_views_read_from_default(self):
+        default, replica = self.cashup_queries('get', reverse(
+            'cashup_outlet_settings', kwargs={'slug': self.outlet.slug}))
+        self.assertGreater(default, 0)
+        self.assertEqual(replica, 0)
+
+    def test_writes_go_to_default(self):
+        tillclosure = create_tillclosure(self.outlet, self.staff)
+        tillclosure = TillClosure.objects.using(REPLICA).get(
+            pk=tillclosure.pk)
+        tillclosure.notes = 'Edited'
+        tillclosure.save()
+        self.assertEqual(tillclosure._state.db, 'default')
+        self.assertEqual(tillclosure.version_number, 2)
+
+    def test_reads_stick_to_default_after_write(self):
+        self.client.post(reverse('cashup_outlet_staff',
+                                 kwargs={'slug': self.outlet.slug}),
+                         {'personnel': [self.staff.pk],
+                          'manager': [self.staff.pk]})
+        self.assertIn(STICKY_COOKIE, self.client.cookies)
+        default, replica = self.cashup_queries('get', self.list_url)
+        self.assertGreater(default, 0)
+        self.assertEqual(replica, 0)
+
+        # the cookie is what makes reads sticky, whichever process serves
+        # the request
+        del self.client.cookies[STICKY_COOKIE]
+        default, replica = self.cashup_queries('get', self.list_url)
+        self.assertEqual(default, 0)
+        self.assertGreater(replica, 0)
+
+    @override_settings(CASHUP_REPLICA_STICKY_SECONDS=-1)
+    def test_stickiness_expires(self):
+        self.client.post(reverse('cashup_outlet_staff',
+                                 kwargs={'slug': self.outlet.slug}),
+                         {'personnel': [self.staff.pk],
+                          'manager': [self.staff.pk]})
+        default, replica = self.cashup_queries('get', self.list_url)
+        self.assertGreater(replica, 0)
+
+
+class TillClosureBulkImportTest(CashupTestCase):
+    def rows(self, count):
+        return [{'outlet': self.outlet.pk, 'closed_by': self.staff.pk,
+                 'close_time': timezone.now(), 'cash_takings': '100.00',
+                 'card_takings': '50.00', 'till_float': '50.00',
+                 'note_20GBP': 5, 'note_10GBP': 5} for i in range(count)]
+
+    def test_batches_get_distinct_identities(self):
+        TillClosure.objects.bulk_import(self.rows(3))
+        result = TillClosure.objects.bulk_import(self.rows(3), batch_size=2)
+        self.assertEqual((result.created, result.errors), (3, []))
+        TillClosure.objects.bulk_import(self.rows(2))
+        closures = TillClosure.audit_trail.all()
+        self.assertEqual(len(closures), 8)
+        self.assertEqual(len({closure.identity for closure in closures}), 8)
+        for closure in closures:
+            self.assertEqual((closure.identity, closure.version_number),
+                             (closure.pk, 1))
+
+    def test_interleaved_batches_dont_conflict(self):
+        bulk_create = TillClosureQuerySet.bulk_create
+        interleaved = []
+
+        def interleave(queryset, objs, *args, **kwargs):
+            # another batch and a single save land between this batch's
+            # insert and the UPDATE which sets its identities
+            created = bulk_create(queryset, objs, *args, **kwargs)
+            if not interleaved:
+                interleaved.append(create_tillclosure(self.outlet, self.staff))
+                TillClosure.objects.bulk_import(self.rows(3))
+            return created
+
+        with mock.patch.object(TillClosureQuerySet, 'bulk_create',
+                               autospec=True, side_effect=interleave):
+            result = TillClosure.objects.bulk_import(self.rows(3))
+        self.assertEqual((result.created, result.errors), (3, []))
+        closures = TillClosure.audit_trail.all()
+        self.assertEqual(len(closures), 7)
+        self.assertEqual(len({closure.identity for closure in closures}), 7)
+        for closure in closures:
+            self.assertEqual((closure.identity, closure.version_number),
+                             (closure.pk, 1))
+
+    def test_identities_not_reused(self):
+        TillClosure.objects.bulk_import(self.rows(2))
+        deleted = TillClosure.objects.latest('pk')
+        deleted.delete()
+        TillClosure.objects.bulk_import(self.rows(1))
+        created = TillClosure.objects.latest('pk')
+        self.assertGreater(created.identity, deleted.identity)
+        self.assertEqual(created.identity, created.pk)
+
+
+class TillClosureBatchCreateTest(CashupTestCase):
+    def setUp(self):
+        super(TillClosureBatchCreateTest, self).setUp()
+        self.other_outlet = create_outlet(self.business, 'Other shop')
+        self.url = reverse('cashup_closure_batch_create')
+
+    def post(self, closures):
+        return self.client.post(self.url, json.dumps({'closures': closures}),
+                                content_type='application/json')
+
+    def closure(self, outlet, **kwargs):
+        data = {'outlet': outlet.pk, 'close_time': '2017-06-01 18:00',
+                'cash_takings': '100.00', 'card_takings': '50.00',
+                'till_float': '50.00', 'note_20GBP': 5, 'note_10GBP': 5}
+        data.update(kwargs)
+        return data
+
+    def test_creates_closures(self):
+        self.login(self.owner)
+        response = self.post([self.closure(self.outlet),
+                              self.closure(self.other_outlet),
+                              self.closure(self.outlet, cash_takings='x')])
+        data = response.json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(list(data['results'][2]['errors']), ['cash_takings'])
+        tillclosure = TillClosure.objects.get(pk=data['results'][1]['pk'])
+        self.assertEqual(data['results'][1]['url'],
+                         tillclosure.get_absolute_url())
+        self.assertEqual(tillclosure.identity, tillclosure.pk)
+        self.assertEqual(tillclosure.outlet, self.other_outlet)
+        self.assertEqual(tillclosure.closed_by, self.owner)
+        self.assertEqual(tillclosure.till_total, Decimal('150.00'))
+        totals = self.outlet.daily_totals.get()
+        self.assertEqual((totals.closures, totals.cash_takings),
+                         (1, Decimal('100.00')))
+
+    def test_checks_outlet_permission(self):
+        other = create_outlet(Business.objects.create(name='Other'), 'Shop')
+        self.login(self.staff)
+        data = self.post([self.closure(self.outlet),
+                          self.closure(self.other_outlet),
+                          self.closure(other)]).json()
+        self.assertEqual(data['created'], 1)
+        self.assertIn('pk', data['results'][0])
+        self.assertEqual(data['results'][1], data['results'][2])
+        self.assertIn('outlet', data['results'][1]['errors'])
+        self.assertEqual(TillClosure.objects.count(), 1)
+
+    def test_queries_per_batch(self):
+        self.login(self.staff)
+        self.post([self.closure(self.outlet)])  # create the day's total
+        with self.assertNumQueries(10):
+            self.post([self.closure(self.outlet)])
+        # without a sequence to reserve pks from, the first closure is
+        # inserted alone and the others' pks read back
+        with self.assertNumQueries(
+                10 if connection.vendor == 'postgresql' else 12):
+            self.post([self.closure(self.outlet)] * 30)
+        self.assertEqual(TillClosure.objects.count(), 32)
+
+    def test_close_time_defaults_to_current_minute(self):
+        self.login(self.owner)
+        data = self.closure(self.outlet)
+        del data['close_time']
+        pk = self.post([data]).json()['results'][0]['pk']
+        close_time = TillClosure.objects.get(pk=pk).close_time
+        self.assertEqual((close_time.second, close_time.microsecond), (0, 0))
+
+    def test_conflict_can_be_retried(self):
+        self.login(self.owner)
+        with mock.patch.object(TillClosure.objects, 'create_batch',
+                               side_effect=IntegrityError):
+            response = self.post([self.closure(self.outlet)])
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('error', response.json())
+
+    def test_rejects_malformed_body(self):
+        self.login(self.owner)
+        response = self.client.post(self.url, 'closures',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post({'outlet': 1}).status_code, 400)
+
+
+@skipUnless(analytics.np, 'NumPy is not installed')
+class TillClosureAnomalyTest(CashupTestCase):
+    def setUp(self):
+        super(TillClosureAnomalyTest, self).setUp()
+        start = timezone.now() - datetime.timedelta(days=30)
+        for i in range(10):
+            create_tillclosure(self.outlet, self.staff, coin_1GBP=i % 3,
+                close_time=start + datetime.timedelta(days=i))
+        self.outlier = create_tillclosure(self.outlet, self.staff,
+            note_20GBP=10, close_time=start + datetime.timedelta(days=10))
+        self.login(self.owner)
+
+    def test_rolling_zscores(self):
+        mean, std, z = analytics.rolling_zscores(
+            analytics.np.array([1, 2, 1, 1, 2, 1]),
+            analytics.np.array([1.0, 10.0, 3.0, 5.0, 20.0, 9.0]),
+            window=2, min_periods=2, min_std=0)
+        self.assertEqual(analytics.np.isnan(z).tolist(),
+                         [True, True, True, False, True, False])
+        self.assertAlmostEqual(mean[3], 2.0)
+        self.assertAlmostEqual(std[3], 2 ** 0.5)
+        self.assertAlmostEqual(z[3], 3 / 2 ** 0.5)
+        self.assertAlmostEqual(mean[5], 4.0)
+        self.assertAlmostEqual(z[5], 5 / 2 ** 0.5)
+
+    def test_outliers(self):
+        anomalies = analytics.closure_anomalies('outlet', self.outlet.pk)
+        self.assertEqual(anomalies['closures'], 11)
+        self.assertEqual(list(anomalies['outliers']), [self.outlier.identity])
+        self.assertEqual(
+            analytics.closure_anomalies('closed_by', self.staff.pk),
+            anomalies)
+
+    def test_list_page(self):
+        response = self.client.get(reverse(
+            'cashup_outlet_detail', kwargs={'slug': self.outlet.slug}))
+        self.assertEqual(response.context['anomalies']['closures'], 11)
+        flagged = [tillclosure.identity
+                   for tillclosure in response.context['object_list']
+                   if tillclosure.difference_z]
+        self.assertEqual(flagged, [self.outlier.identity])
+        self.assertContains(response, '1 closure stands out')
+
+    def test_cache_kept_for_other_groups(self):
+        other = create_outlet(self.business, 'Other shop')
+        analytics.closure_anomalies('outlet', self.outlet.pk)
+        create_tillclosure(other, self.owner)
+        with self.assertNumQueries(0):
+            analytics.closure_anomalies('outlet', self.outlet.pk)
+
+    def assert_move_invalidates_both_outlets(self):
+        other = create_outlet(self.business, 'Other shop')
+        analytics.closure_anomalies('outlet', self.outlet.pk)
+        analytics.closure_anomalies('outlet', other.pk)
+        self.outlier.outlet = other
+        self.outlier.save()
+        self.assertEqual(
+            analytics.closure_anomalies('outlet', self.outlet.pk)['closures'],
+            10)
+        self.assertEqual(
+            analytics.closure_anomalies('outlet', other.pk)['closures'], 1)
+
+    def test_move_invalidates_both_outlets(self):
+        self.assert_move_invalidates_both_outlets()
+
+    @override_settings(CASHUP_AUDIT_DELTAS=True)
+    def test_move_invalidates_both_outlets_with_deltas(self):
+        self.assert_move_invalidates_both_outlets()
+
+    @override_settings(CASHUP_ARCHIVE_SUPERSEDED=True)
+    def test_move_invalidates_both_outlets_when_archiving(self):
+        self.assert_move_invalidates_both_outlets()
+
+    def test_cached_until_closures_change(self):
+        analytics.closure_anomalies('outlet', self.outlet.pk)
+        with self.assertNumQueries(0):
+            analytics.closure_anomalies('outlet', self.outlet.pk)
+        self.outlier.delete()
+        self.assertEqual(
+            analytics.closure_anomalies('outlet', self.outlet.pk)['outliers'],
+            {})
+        data = dict.fromkeys((f.name for f in DENOMINATION_FIELDS), 0)
+        data.update(outlet=self.outlet.pk, closed_by=self.staff.pk,
+                    close_time=timezone.now(), cash_takings=Decimal('10.00'),
+                    card_takings=Decimal('0.00'), till_float=Decimal('50.00'))
+        created, = TillClosure.objects.create_batch([data])
+        self.assertEqual(
+            list(analytics.closure_anomalies(
+                'outlet', self.outlet.pk)['outliers']),
+            [created.identity])
+
+
+class TillClosureListQueryCountTest(CashupTestCase):
+    def test_query_count_constant_with_deleted_rows(self):
+        self.login(self.owner)
+        urls = [reverse('cashup_outlet_detail',
+                        kwargs={'slug': self.outlet.slug}),
+                reverse('cashup_personnel_closures',
+                        kwargs={'username': 'staff'})]
+        def count_queries():
+            counts = []
+            for url in urls:
+                self.client.get(url, {'showdeleted': '1'})
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, {'showdeleted': '1'})
+                counts.append(len(queries))
+            return response, counts
+        create_tillclosure(self.outlet, self.staff)
+        expected = count_queries()[1]
+        for i in range(5):
+            tillclosure = create_tillclosure(self.outlet, self.staff)
+            tillclosure.notes = 'Edited'
+            tillclosure.save()
+            if i % 2:
+                TillClosure.objects.filter(pk=tillclosure.pk).update(
+                    version_superseded_time=timezone.now())
+        response, counts = count_queries()
+        self.assertEqual(counts, expected)
+        self.assertEqual(
+            [t.is_deleted for t in response.context['object_list']].count(
+                True), 2)
+
+
+class StaffPermissionMemoTest(CashupTestCase):
+    def setUp(self):
+        super(StaffPermissionMemoTest, self).setUp()
+        self.user = get_user_model().objects.select_related('profile').get(
+            pk=self.staff.user.pk)
+
+    def test_memoized(self):
+        self.assertTrue(self.user.has_perm('cashup.view_outlet', self.outlet))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.user.has_perm('cashup.view_outlet',
+                                               self.outlet))
+            self.assertFalse(self.user.has_perm('cashup.change_outlet',
+                                                self.outlet))
+
+    def test_invalidated_on_save(self):
+        self.assertFalse(self.user.has_perm('cashup.change_outlet',
+                                            self.outlet))
+        position = StaffPosition.objects.get(personnel=self.staff)
+        position.is_manager = True
+        position.save()
+        self.assertTrue(self.user.has_perm('cashup.change_outlet',
+                                           self.outlet))
+        other = create_outlet(self.business, 'Other')
+        self.assertFalse(self.user.has_perm('cashup.view_outlet', other))
+        StaffPosition.objects.create(personnel=self.staff, outlet=other,
+                                     is_staff=True)
+        self.assertTrue(self.user.has_perm('cashup.view_outlet', other))
+
+    def test_invalidated_on_delete(self):
+        self.assertTrue(self.user.has_perm('cashup.view_outlet', self.outlet))
+        StaffPosition.objects.get(personnel=self.staff).delete()
+        self.assertFalse(self.user.has_perm('cashup.view_outlet',
+                                            self.outlet))
+
+
+class OutletMenuCacheTest(CashupTestCase):
+    def menu(self, personnel):
+        return [outlet.name for outlet in outlets_for_menu(personnel)]
+
+    def test_cached(self):
+        self.assertEqual(self.menu(self.staff), ['Shop'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.menu(self.staff), ['Shop'])
+
+    def test_invalidated_on_outlet_change(self):
+        self.assertEqual(self.menu(self.owner), ['Shop'])
+        other = create_outlet(self.business, 'Other')
+        self.assertEqual(self.menu(self.owner), ['Other', 'Shop'])
+        other.name = 'Cafe'
+        other.save()
+        self.assertEqual(self.menu(self.owner), ['Cafe', 'Shop'])
+        other.delete()
+        self.assertEqual(self.menu(self.owner), ['Shop'])
+
+    def test_invalidated_on_staff_position_change(self):
+        other = create_outlet(self.business, 'Other')
+        self.assertEqual(self.menu(self.staff), ['Shop'])
+        position = StaffPosition.objects.create(
+            personnel=self.staff, outlet=other, is_staff=True)
+        self.assertEqual(self.menu(self.staff), ['Other', 'Shop'])
+        position.delete()
+        self.assertEqual(self.menu(self.staff), ['Shop'])
+
+
+class OutletForPersonnelTest(CashupTestCase):
+    def names(self, personnel, **kwargs):
+        return list(Outlet.objects.for_personnel(
+            personnel, **kwargs).values_list('name', flat=True))
+
+    def test_owner(self):
+        managed = create_outlet(self.business, 'Managed')
+        for outlet in (self.outlet, managed):
+            StaffPosition.objects.create(personnel=self.owner, outlet=outlet,
+                                         is_manager=True, is_staff=True)
+        create_outlet(Business.objects.create(name='Other'), 'Elsewhere')
+        self.assertEqual(self.names(self.owner), ['Managed', 'Shop'])
+        self.assertEqual(self.names(self.owner, is_manager=True),
+                         ['Managed', 'Shop'])
+
+    def test_staff(self):
+        managed = create_outlet(self.business, 'Managed')
+        StaffPosition.objects.create(personnel=self.staff, outlet=managed,
+                                     is_manager=True, is_staff=True)
+        former = create_outlet(self.business, 'Former')
+        StaffPosition.objects.create(personnel=self.staff, outlet=former)
+        create_outlet(self.business, 'Unrelated')
+        self.assertEqual(self.names(self.staff), ['Managed', 'Shop'])
+        self.assertEqual(self.names(self.staff, is_manager=True),
+                         ['Managed'])
+        self.assertEqual(self.names(self.staff.pk), ['Managed', 'Shop'])
+
+
+class TillClosureTotalTest(CashupTestCase):
+    def test_denomination_value_exact(self):
+        for count, pence_value, value in ((3, 10, '0.30'), (7, 1, '0.07'),
+                                          (3, 20, '0.60'), (0, 50, '0.00'),
+                                          (13, 5000, '650.00')):
+            with self.subTest(count=count, pence_value=pence_value):
+                denomination = DenominationCount(count, pence_value)
+                self.assertEqual(str(denomination.value), value)
+                self.assertEqual(denomination.pretty_value, value)
+
+    def test_total_exact(self):
+        tillclosure = create_tillclosure(
+            self.outlet, self.staff, note_20GBP=0, note_10GBP=0,
+            coin_10p=3, coin_20p=3, coin_2p=4, coin_1p=7,
+            cash_takings=Decimal('0.00'), till_float=Decimal('0.00'))
+        self.assertEqual(str(tillclosure.till_total), '1.05')
+        tillclosure = TillClosure.objects.get(pk=tillclosure.pk)
+        self.assertEqual(str(tillclosure.total()), '1.05')
+        self.assertEqual(tillclosure.till_difference, Decimal('1.05'))
+
+
+class TillClosureExportTest(CashupTestCase):
+    headers = (['id', 'close_time', 'closed_by', 'cash_takings',
+                'card_takings', 'total_takings'] +
+               [f.name for f in DENOMINATION_FIELDS] +
+               ['till_total', 'till_float', 'till_difference', 'notes',
+                'version', 'deleted'])
+
+    def setUp(self):
+        super(TillClosureExportTest, self).setUp()
+        now = timezone.now()
+        for i in range(3):
+            tillclosure = create_tillclosure(
+                self.outlet, self.staff, coin_10p=i,
+                notes='Note, "{}"'.format(i),
+                close_time=now - datetime.timedelta(hours=i))
+        tillclosure.notes = 'Edited'
+        tillclosure.save()
+        TillClosure.objects.filter(pk=tillclosure.pk).update(
+            version_superseded_time=now)
+        self.url = reverse('cashup_outlet_export',
+                           kwargs={'slug': self.outlet.slug})
+        self.login(self.owner)
+
+    def expected_rows(self, params):
+        # the list page's rows, exported field by field from the instances
+        response = self.client.get(reverse(
+            'cashup_outlet_detail', kwargs={'slug': self.outlet.slug}), params)
+        rows = []
+        for tillclosure in response.context['object_list']:
+            tillclosure = TillClosure.audit_trail.get(pk=tillclosure.pk)
+            rows.append(
+                [tillclosure.identity, tillclosure.close_time,
+                 tillclosure.closed_by.user.username,
+                 tillclosure.cash_takings, tillclosure.card_takings,
+                 tillclosure.total_takings] +
+                [getattr(tillclosure, f.name).count
+                 for f in DENOMINATION_FIELDS] +
+                [tillclosure.till_total, tillclosure.till_float,
+                 tillclosure.till_difference, tillclosure.notes,
+                 tillclosure.version_number, tillclosure.is_deleted])
+        return rows
+
+    def test_csv(self):
+        for params in ({}, {'showdeleted': '1', 'order-by': '-takings'}):
+            with self.subTest(params=params):
+                response = self.client.get(self.url, params)
+                self.assertEqual(response['Content-Type'], 'text/csv')
+                self.assertEqual(
+                    response['Content-Disposition'],
+                    'attachment; filename="{}-closures.csv"'.format(
+                        self.outlet.slug))
+                content = b''.join(response.streaming_content).decode()
+                self.assertEqual(
+                    list(csv.reader(io.StringIO(content))),
+                    [self.headers] + [[str(value) for value in row]
+                                      for row in self.expected_rows(params)])
+
+    def test_json(self):
+        params = {'showdeleted': '1', 'format': 'json'}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="{}-closures.json"'.format(
+                             self.outlet.slug))
+        data = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data, json.loads(json.dumps(
+            [dict(zip(self.headers, row))
+             for row in self.expected_rows(params)], cls=DjangoJSONEncoder)))
+
+    def test_empty_json(self):
+        self.outlet.tillclosures.all().delete()
+        response = self.client.get(self.url, {'format': 'json'})
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content).decode()), [])
+
+    def test_requires_permission(self):
+        other = create_outlet(self.business, 'Other')
+        self.login(self.staff)
+        response = self.client.get(reverse(
+            'cashup_outlet_export', kwargs={'slug': other.slug}))
+        self.assertNotEqual(response.status_code, 200)
+
+
+class BenchmarkTest(CashupTestCase):
+    def test_find_regressions(self):
+        baseline = {'urls': {'list': {'owner': {
+            'status': 200, 'queries': 10, 'p50_ms': 10.0, 'peak_kb': 100.0}}}}
+        results = {'urls': {'list': {'owner': {
+            'status': 500, 'queries': 10, 'p50_ms': 11.9, 'peak_kb': 90.0}}}}
+        self.assertEqual(find_regressions(results, baseline, 0.2), [])
+        results['urls']['list']['owner']['p50_ms'] = 12.1
+        self.assertEqual(find_regressions(results, baseline, 0.2),
+                         ['urls.list.owner.p50_ms: 10.0 -> 12.1'])
+
+    def test_any_extra_query_regresses(self):
+        baseline = {'total': {'queries': 10}, 'urls': {}}
+        self.assertEqual(
+            find_regressions({'total': {'queries': 11}}, baseline, 0.5),
+            ['total.queries: 10 -> 11'])
+        self.assertEqual(
+            find_regressions({'total': {'queries': 9}, 'other': {'queries': 1}},
+                             baseline, 0.5), [])
+
+    def test_urls_count_queries(self):
+        options = {'businesses': 1, 'outlets': 2, 'personnel': 6,
+                   'closures': 20, 'requests': 2}
+        results = cashup_urls(io.StringIO(), options)
+        export = results['cashup_outlet_export']['owner']
+        self.assertEqual(export['status'], 200)
+        self.assertGreater(export['queries'], 0)
+        for name, roles in results.items():
+            for role, result in roles.items():
+                with self.subTest(url=name, role=role):
+                    self.assertGreater(result['queries'], 0)
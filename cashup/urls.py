@@ -6,6 +6,8 @@ urlpatterns = [
         name='home'),
     url(r'^business/$', views.BusinessDetailView.as_view(),
         name='cashup_business_detail'),
+    url(r'^business/dashboard/$', views.BusinessDashboardView.as_view(),
+        name='cashup_business_dashboard'),
     url(r'^business/settings/$', views.BusinessUpdateView.as_view(),
         name='cashup_business_update'),
     url(r'^staff/$',
@@ -20,17 +22,29 @@ urlpatterns = [
     url(r'^staff/(?P<username>[\w.@+-]+)/closures/$',
         views.PersonnelTillClosureListView.as_view(),
         name='cashup_personnel_closures'),
+    url(r'^staff/(?P<username>[\w.@+-]+)/closures/export/$',
+        views.PersonnelTillClosureExportView.as_view(),
+        name='cashup_personnel_closures_export'),
     url(r'^outlets/$', views.OutletListView.as_view(),
         name='cashup_outlet_list'),
     url(r'^outlets/(?P<slug>[\w.@+-]+)/$',
         views.OutletTillClosureListView.as_view(),
         name='cashup_outlet_detail'),
+    url(r'^outlets/(?P<slug>[\w.@+-]+)/export/$',
+        views.OutletTillClosureExportView.as_view(),
+        name='cashup_outlet_export'),
     url(r'^outlets/(?P<slug>[\w.@+-]+)/settings/$',
         views.OutletUpdateView.as_view(),
         name='cashup_outlet_settings'),
+    url(r'^outlets/(?P<slug>[\w.@+-]+)/staff/$',
+        views.OutletStaffView.as_view(),
+        name='cashup_outlet_staff'),
     url(r'^outlet/new/$',
         views.OutletCreateView.as_view(),
         name='cashup_outlet_create'),
+    url(r'^closures/batch/$',
+        views.TillClosureBatchCreateView.as_view(),
+        name='cashup_closure_batch_create'),
     url(r'^closures/(?P<pk>[0-9]+)/$',
         views.TillClosureDetailView.as_view(),
         name='cashup_closure_detail'),
@@ -1,9 +1,56 @@
 import datetime
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 
 def in_editable_period(time):
     time_limit = getattr(settings, "CASHUP_EDITABLE_PERIOD", 86400)
     return timezone.now() < (time + datetime.timedelta(seconds=time_limit))
+
+
+def get_date_range(params):
+    """
+    Returns the dates given as `from` and `to` in params (e.g. request.GET)
+    as a tuple. Either may be None if missing or invalid.
+    """
+    dates = []
+    for key in ('from', 'to'):
+        try:
+            dates.append(parse_date(params.get(key) or ''))
+        except ValueError:
+            dates.append(None)
+    return tuple(dates)
+
+
+def start_of_day(date):
+    """Returns the first moment of date in the current time zone."""
+    start = datetime.datetime.combine(date, datetime.time.min)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+    return start
+
+
+def _version_key(prefix, parts):
+    return ':'.join(['{}-version'.format(prefix)] + [str(p) for p in parts])
+
+
+def cache_version(prefix, *parts):
+    """
+    Returns a counter kept in the cache for `prefix` and optional `parts`,
+    for use in the keys of cached values which depend on the same data.
+    Incrementing it with `bump_cache_version` invalidates them all.
+    """
+    # seeded from the clock so an evicted counter never reuses old keys
+    return cache.get_or_set(_version_key(prefix, parts),
+                            lambda: int(time.time() * 1000), None)
+
+
+def bump_cache_version(prefix, *parts):
+    try:
+        cache.incr(_version_key(prefix, parts))
+    except ValueError:
+        cache_version(prefix, *parts)
@@ -1,23 +1,60 @@
+import calendar
+import csv
+import datetime
+import hashlib
+import json
+
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.views.generic import (ListView, DetailView, CreateView, UpdateView,
-                                  RedirectView)
+from django.views.generic import (View, ListView, DetailView, CreateView,
+                                  UpdateView, RedirectView)
 from django.views.generic.detail import SingleObjectMixin
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.core.cache import cache
+from django.http import (HttpResponse, HttpResponseRedirect,
+                         HttpResponseBadRequest, StreamingHttpResponse,
+                         JsonResponse, Http404)
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import PermissionDenied
 from django.urls import reverse, reverse_lazy
-from django.db.models import Sum, F
-from django.forms import inlineformset_factory
+from django.core.paginator import Paginator, InvalidPage
+from django.db import IntegrityError
+from django.db.models import Q, Sum, F, prefetch_related_objects
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
 
 import rules
 from rules.contrib.views import PermissionRequiredMixin
 
-from .models import Business, Outlet, TillClosure, Personnel, StaffPosition
-from .forms import OutletForm, StaffFormSet, StaffPositionForm
+from .analytics import closure_anomalies
+from .models import (Business, Outlet, TillClosure, Personnel, StaffPosition,
+                     DENOMINATION_FIELDS)
+from .modelfields import DenominationCount
+from .pagination import cursor_paginate, InvalidCursor
+from .routers import ReplicaReadMixin
+from .context_processors import outlet_menu_version
+from .utils import (get_date_range, in_editable_period, start_of_day,
+                    cache_version, bump_cache_version)
+from .forms import OutletForm, StaffChangesForm, TillClosureImportForm
 
 
 # General views
 
+class PermissionObjectMixin(object):
+    """
+    Reuses the object fetched for the permission check in the view rather
+    than fetching it a second time.
+    """
+    def get_permission_object(self):
+        self.object = self.get_object()
+        return self.object
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(object=self.object)
+        return self.render_to_response(context)
+
+
 class SimpleHomeRedirectView(LoginRequiredMixin, RedirectView):
     permanent = False
 
@@ -40,6 +77,39 @@ class BusinessDetailView(LoginRequiredMixin, PermissionRequiredMixin,
         return self.request.user.profile.business
 
 
+class BusinessDashboardView(LoginRequiredMixin, ReplicaReadMixin,
+                            PermissionRequiredMixin, DetailView):
+    """
+    Compares the takings of all the business's Outlets between the `from`
+    and `to` dates (defaulting to the last `default_days` days).
+    """
+    permission_required = 'cashup.view_business'
+    template_name = 'cashup/business_dashboard.html'
+    default_days = 30
+
+    def get_object(self):
+        return self.request.user.profile.business
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(BusinessDashboardView, self).get_context_data(
+            *args, **kwargs)
+        start, end = get_date_range(self.request.GET)
+        end = end or timezone.localtime(timezone.now()).date()
+        start = start or end - datetime.timedelta(days=self.default_days)
+        outlets = list(self.object.outlets.with_totals(
+            start, end).order_by('name'))
+        context.update({
+            'from': start,
+            'to': end,
+            'outlet_totals': outlets,
+            'totals': {name: sum(getattr(o, name) for o in outlets)
+                       for name in ('closures', 'cash_takings',
+                                    'card_takings', 'total_takings',
+                                    'till_difference', 'to_bank')},
+        })
+        return context
+
+
 class BusinessUpdateView(LoginRequiredMixin, PermissionRequiredMixin,
                                                                 UpdateView):
     permission_required = 'cashup.change_business'
@@ -90,38 +160,18 @@ class OutletListView(LoginRequiredMixin, ListView):
         return Outlet.objects.for_personnel(self.request.user.profile)
 
 
-class OutletUpdateView(LoginRequiredMixin, PermissionRequiredMixin,
-                                                                UpdateView):
+class OutletUpdateView(LoginRequiredMixin, PermissionObjectMixin,
+                       PermissionRequiredMixin, UpdateView):
+    """
+    Outlet settings, with a searchable, paginated list of the business's
+    Personnel for choosing the Outlet's staff. Staff changes are posted to
+    OutletStaffView.
+    """
     model = Outlet
     permission_required = 'cashup.change_outlet'
     form_class = OutletForm
     success_url = '/'
-    staff_form_class = StaffFormSet
-
-    def post(self, request, *args, **kwargs):
-        redirect = super(OutletUpdateView, self).post(request, *args, **kwargs)
-
-        staff_form = self.create_formset(request.POST)
-        if staff_form.is_valid():
-            staff_form.save()
-        else:
-            self.invalid_staff_form = staff_form
-            return self.render_to_response(self.get_context_data())
-        return redirect
-
-    def create_formset(self, data=None):
-        potential_staff = self.object.business.personnel.exclude(
-            positions__outlet=self.object)
-        initial = [
-            {'personnel': person.pk} for person in potential_staff]
-        Form = inlineformset_factory(Outlet,
-                                     StaffPosition,
-                                     form=StaffPositionForm,
-                                     extra=len(potential_staff),
-                                     can_delete=False)
-        qs = StaffPosition.objects.filter(
-            outlet=self.object).exclude(personnel__is_owner=True)
-        return Form(data, instance=self.object, queryset=qs, initial=initial)
+    staff_paginate_by = 25
 
     def get_queryset(self):
         return Outlet.objects.for_personnel(self.request.user.profile)
@@ -129,16 +179,66 @@ class OutletUpdateView(LoginRequiredMixin, PermissionRequiredMixin,
     def get_success_url(self):
         return self.object.get_absolute_url()
 
+    def get_staff_page(self):
+        query = self.request.GET.get('q', '').strip()
+        candidates = Personnel.objects.filter(
+            business_id=self.object.business_id, is_owner=False
+        ).select_related('user').order_by('user__username')
+        if query:
+            candidates = candidates.filter(
+                Q(user__username__icontains=query) |
+                Q(user__first_name__icontains=query) |
+                Q(user__last_name__icontains=query))
+        paginator = Paginator(candidates, self.staff_paginate_by)
+        try:
+            page = paginator.page(self.request.GET.get('staff-page', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+        positions = {position.personnel_id: position for position in
+                     StaffPosition.objects.filter(
+                         outlet=self.object, personnel__in=list(page))}
+        page.object_list = [(personnel, positions.get(personnel.pk))
+                            for personnel in page]
+        return query, page
+
     def get_context_data(self, *args, **kwargs):
         context = super(OutletUpdateView, self).get_context_data(
             *args, **kwargs)
-        if hasattr(self, 'invalid_staff_form'):
-            context['staff_forms'] = self.invalid_staff_form
-        else:
-            context['staff_forms'] = self.create_formset()
+        context['staff_query'], context['staff_page'] = self.get_staff_page()
         return context
 
 
+class OutletStaffView(LoginRequiredMixin, PermissionObjectMixin,
+                      PermissionRequiredMixin, SingleObjectMixin, View):
+    """
+    Applies a StaffChangesForm change set to an Outlet's StaffPositions.
+    Redirects back to the settings page, or for AJAX requests responds with
+    the number of positions created, updated and deleted.
+    """
+    permission_required = 'cashup.change_outlet'
+    http_method_names = ['post']
+
+    def get_queryset(self):
+        return Outlet.objects.for_personnel(self.request.user.profile)
+
+    def post(self, request, *args, **kwargs):
+        form = StaffChangesForm(request.POST, business=self.object.business)
+        if not form.is_valid():
+            if request.is_ajax():
+                return JsonResponse({'errors': form.errors}, status=400)
+            return HttpResponseBadRequest('Invalid staff changes')
+        counts = StaffPosition.objects.apply_changes(
+            self.object, form.changes())
+        if request.is_ajax():
+            return JsonResponse(counts)
+        params = {key: request.POST[key] for key in ('q', 'staff-page')
+                  if request.POST.get(key)}
+        url = reverse('cashup_outlet_settings', args=[self.object.slug])
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+        return HttpResponseRedirect(url)
+
+
 class OutletCreateView(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
     model = Outlet
     permission_required = 'cashup.create_outlet'
@@ -167,14 +267,19 @@ class OutletTillClosureMixin(object):
 
 
 
-class TillClosureListViewBase(LoginRequiredMixin, PermissionRequiredMixin,
-                                                SingleObjectMixin, ListView):
+class TillClosureListViewBase(LoginRequiredMixin, ReplicaReadMixin,
+                    PermissionRequiredMixin, SingleObjectMixin, ListView):
     order_dict = {'date': 'close_time',
                   '-date': '-close_time',
                   'takings': 'total_takings',
                   '-takings': '-total_takings',
                   'difference': 'till_difference',
                   '-difference': '-till_difference'}
+    default_order_by = '-date'
+    # the only columns the list template needs; `is_deleted` is annotated
+    list_fields = ['identity', 'close_time', 'total_takings', 'till_difference']
+    paginate_by = 50
+    cursor_pagination = True
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
@@ -190,22 +295,89 @@ class TillClosureListViewBase(LoginRequiredMixin, PermissionRequiredMixin,
         """
         show_deleted = self.request.GET.get('showdeleted', 0) == '1'
         order_by = self.request.GET.get('order-by', None)
-        if not show_deleted or not self.has_audit_perms():
+        self.show_deleted = show_deleted and self.has_audit_perms()
+        if not self.show_deleted:
             self.queryset = self.queryset.filter(version_superseded_time=None)
+        self.date_from, self.date_to = get_date_range(self.request.GET)
+        if self.date_from:
+            self.queryset = self.queryset.filter(
+                close_time__gte=start_of_day(self.date_from))
+        if self.date_to:
+            self.queryset = self.queryset.filter(close_time__lt=start_of_day(
+                self.date_to + datetime.timedelta(days=1)))
         if order_by in self.order_dict:
             self.order_by = order_by
             self.queryset = self.queryset.order_by(self.order_dict[order_by])
+        self.queryset = self.queryset.only(*self.list_fields)
         return self.queryset
 
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Pages through closures by seeking past the last row shown, keyed on
+        the active ordering and `identity`, so deep pages are as cheap as
+        the first and no count is needed. A cursor which doesn't match the
+        ordering (or can't be read) starts again from the first page.
+        Set `cursor_pagination = False` for Django's numbered pages.
+        """
+        if not self.cursor_pagination:
+            return super(TillClosureListViewBase, self).paginate_queryset(
+                queryset, page_size)
+        ordering = self.order_dict[
+            getattr(self, 'order_by', self.default_order_by)]
+        try:
+            page = cursor_paginate(queryset, ordering, page_size,
+                                   self.request.GET.get('cursor'))
+        except InvalidCursor:
+            page = cursor_paginate(queryset, ordering, page_size)
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def get_page_url(self, cursor=None):
+        """
+        Returns the query string for the page at `cursor` (or the first
+        page), keeping the current ordering, date range and `showdeleted`.
+        """
+        params = self.request.GET.copy()
+        for key in ('cursor', 'page'):
+            params.pop(key, None)
+        if cursor:
+            params['cursor'] = cursor
+        return '?' + params.urlencode()
+
     def get_context_data(self, *args, **kwargs):
         context = super(TillClosureListViewBase, self).get_context_data(
             *args, **kwargs)
         if hasattr(self, 'order_by'):
             context['order_by'] = self.order_by
-        context['totals'] = self.queryset.aggregate(
+        context['export_url'] = reverse(self.export_url_name,
+                                        kwargs=self.kwargs)
+        context['from'] = self.date_from
+        context['to'] = self.date_to
+        context['totals'] = self.get_totals()
+        context['anomalies'] = self.get_anomalies(context['object_list'])
+        page = context['page_obj']
+        if self.cursor_pagination and page is not None:
+            context['first_page_url'] = self.get_page_url()
+            context['next_page_url'] = self.get_page_url(page.next_cursor)
+            context['previous_page_url'] = self.get_page_url(
+                page.previous_cursor)
+        return context
+
+    def get_anomalies(self, object_list):
+        """
+        Returns the till difference analysis for the object's closures, and
+        sets `difference_z` on those shown which stand out.
+        """
+        anomalies = closure_anomalies(self.anomaly_field, self.object.pk)
+        if anomalies:
+            for tillclosure in object_list:
+                tillclosure.difference_z = anomalies['outliers'].get(
+                    tillclosure.identity)
+        return anomalies
+
+    def get_totals(self):
+        return self.queryset.aggregate(
             total_takings=Sum('total_takings'),
             till_difference=Sum('till_difference'))
-        return context
 
 
 class OutletTillClosureListView(TillClosureListViewBase):
@@ -213,6 +385,8 @@ class OutletTillClosureListView(TillClosureListViewBase):
     context_object_name = 'outlet'
     permission_required = ['cashup.view_outlet', 'cashup.view_tillclosures_for_outlet']
     audit_perms = 'cashup.view_outlet_tillclosure_audit_trail'
+    export_url_name = 'cashup_outlet_export'
+    anomaly_field = 'outlet'
 
     def get_object(self, *args, **kwargs):
         queryset=Outlet.objects.for_personnel(self.request.user.profile)
@@ -221,15 +395,27 @@ class OutletTillClosureListView(TillClosureListViewBase):
 
     def get_queryset(self):
         self.queryset = TillClosure.audit_trail.filter(
-            pk=F('identity'), outlet=self.object)
+            pk=F('identity'), outlet=self.object).with_deleted_status()
         return super(OutletTillClosureListView, self).get_queryset()
 
+    def get_totals(self):
+        if self.show_deleted:
+            return super(OutletTillClosureListView, self).get_totals()
+        daily_totals = self.object.daily_totals.all()
+        if self.date_from:
+            daily_totals = daily_totals.filter(date__gte=self.date_from)
+        if self.date_to:
+            daily_totals = daily_totals.filter(date__lte=self.date_to)
+        return daily_totals.totals()
+
 
 class PersonnelTillClosureListView(TillClosureListViewBase):
     template_name = 'cashup/personnel_tillclosure_list.html'
     context_object_name = 'personnel'
     permission_required = ['cashup.view_personnel_tillclosure_list']
     audit_perms = 'cashup.view_personnel_tillclosure_audit_trail'
+    export_url_name = 'cashup_personnel_closures_export'
+    anomaly_field = 'closed_by'
     slug_url_kwarg = 'username'
     slug_field = 'user__username'
 
@@ -239,31 +425,159 @@ class PersonnelTillClosureListView(TillClosureListViewBase):
 
     def get_queryset(self):
         self.queryset = TillClosure.audit_trail.filter(
-            pk=F('identity'), closed_by=self.object)
+            pk=F('identity'), closed_by=self.object).with_deleted_status()
         return super(PersonnelTillClosureListView, self).get_queryset()
 
 
-class TillClosureAuditTrailListView(LoginRequiredMixin, PermissionRequiredMixin,
-                                                                DetailView):
+class Echo(object):
+    """File-like object for csv.writer which returns each line written."""
+    def write(self, value):
+        return value
+
+
+class TillClosureExportMixin(object):
+    """
+    Streams the closures of a TillClosureListViewBase subclass as CSV, or as
+    JSON with `?format=json`, honouring its `showdeleted` and `order-by`
+    parameters and permissions.
+    Rows are read with `values_list().iterator()` so memory use doesn't
+    depend on the length of the history exported.
+    """
+    export_fields = (['identity', 'close_time', 'closed_by__user__username',
+                      'cash_takings', 'card_takings', 'total_takings'] +
+                     [f.name for f in DENOMINATION_FIELDS] +
+                     ['till_total', 'till_float', 'till_difference', 'notes',
+                      'version_number', 'current_version_exists'])
+    export_headers = (['id', 'close_time', 'closed_by',
+                       'cash_takings', 'card_takings', 'total_takings'] +
+                      [f.name for f in DENOMINATION_FIELDS] +
+                      ['till_total', 'till_float', 'till_difference', 'notes',
+                       'version', 'deleted'])
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        rows = self.get_queryset().values_list(
+            *self.export_fields).iterator()
+        rows = (self.export_row(row) for row in rows)
+        if request.GET.get('format') == 'json':
+            content = self.stream_json(rows)
+            content_type, extension = 'application/json', 'json'
+        else:
+            content = self.stream_csv(rows)
+            content_type, extension = 'text/csv', 'csv'
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename="{}-closures.{}"'.format(
+                kwargs.get(self.slug_url_kwarg), extension))
+        return response
+
+    def export_row(self, row):
+        row = [value.count if isinstance(value, DenominationCount) else value
+               for value in row]
+        row[-1] = not row[-1]  # current_version_exists -> deleted
+        return row
+
+    def stream_csv(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.export_headers)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def stream_json(self, rows):
+        separator = '[\n'
+        for row in rows:
+            yield separator + json.dumps(dict(zip(self.export_headers, row)),
+                                         cls=DjangoJSONEncoder)
+            separator = ',\n'
+        yield '[]\n' if separator == '[\n' else '\n]\n'
+
+
+class OutletTillClosureExportView(TillClosureExportMixin,
+                                  OutletTillClosureListView):
+    pass
+
+
+class PersonnelTillClosureExportView(TillClosureExportMixin,
+                                     PersonnelTillClosureListView):
+    pass
+
+
+def audit_page_version():
+    return cache_version('cashup:audit-page')
+
+def invalidate_audit_pages():
+    bump_cache_version('cashup:audit-page')
+
+
+class AuditTrailCacheMixin(object):
+    """
+    Answers conditional GETs for audit trail pages with 304 Not Modified
+    and caches their rendered content.
+    The ETag is built from the version shown along with everything else the
+    page depends on (see `get_cache_parts`), so a new version simply has a
+    new ETag. The names shown, of the business, outlet and personnel, are
+    covered by `audit_page_version`, which is bumped when any of them
+    changes.
+    """
+    def get_cache_parts(self):
+        return [self.object.identity, self.object.version_number,
+                self.object.version_created_time.isoformat(),
+                self.request.user.pk, outlet_menu_version(),
+                audit_page_version()]
+
+    def get(self, request, *args, **kwargs):
+        parts = [self.__class__.__name__] + self.get_cache_parts()
+        etag = quote_etag(hashlib.md5(
+            repr(parts).encode('utf-8')).hexdigest())
+        last_modified = calendar.timegm(
+            self.object.version_created_time.utctimetuple())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            key = 'cashup:audit-page:{}'.format(etag.strip('"'))
+            content = cache.get(key)
+            if content is None:
+                response = super(AuditTrailCacheMixin, self).get(
+                    request, *args, **kwargs)
+                content = response.render().content
+                timeout = getattr(settings, 'CASHUP_AUDIT_PAGE_TIMEOUT',
+                                  7 * 86400)
+                cache.set(key, content, timeout)
+            else:
+                response = HttpResponse(content)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class TillClosureAuditTrailListView(LoginRequiredMixin, ReplicaReadMixin,
+        AuditTrailCacheMixin, PermissionObjectMixin, PermissionRequiredMixin,
+        DetailView):
     template_name = 'cashup/tillclosure_audit_trail_list.html'
     permission_required = 'cashup.view_tillclosure_audit_trail'
-    model = TillClosure
+    queryset = TillClosure.objects.select_related(
+        'outlet__business', 'closed_by__user')
 
     def get_context_data(self, *args, **kwargs):
         context = super(TillClosureAuditTrailListView, self).get_context_data(
             *args, **kwargs)
         tillclosure = context['object']
         context['outlet'] = tillclosure.outlet
-        pk = tillclosure.pk
-        audit_trail = TillClosure.audit_trail.filter(identity=pk)
-        context['object_list'] = audit_trail
+        versions = tillclosure.versions()
+        editors = Personnel.objects.select_related('user').in_bulk(
+            {version.updated_by_id for version in versions})
+        for version in versions:
+            version.updated_by = editors.get(version.updated_by_id)
+        context['object_list'] = versions
         return context
 
 
-class TillClosureDetailView(LoginRequiredMixin, PermissionRequiredMixin,
-                                                                DetailView):
+class TillClosureDetailView(LoginRequiredMixin, ReplicaReadMixin,
+        PermissionObjectMixin, PermissionRequiredMixin, DetailView):
     permission_required = 'cashup.view_tillclosure'
-    queryset = TillClosure.audit_trail.filter(pk=F('identity'))
+    queryset = TillClosure.audit_trail.filter(
+        pk=F('identity')).with_deleted_status().select_related(
+        'outlet__business', 'closed_by__user', 'updated_by__user')
 
     def get_context_data(self, *args, **kwargs):
         context = super(TillClosureDetailView, self).get_context_data(
@@ -272,17 +586,37 @@ class TillClosureDetailView(LoginRequiredMixin, PermissionRequiredMixin,
         return context
 
 
-class TillClosureAuditTrailDetailView(LoginRequiredMixin,
-                                        PermissionRequiredMixin, DetailView):
+class TillClosureAuditTrailDetailView(LoginRequiredMixin, ReplicaReadMixin,
+        AuditTrailCacheMixin, PermissionObjectMixin, PermissionRequiredMixin,
+        DetailView):
     permission_required = 'cashup.view_tillclosure_audit_trail'
     template_name = 'cashup/tillclosure_audit_trail_detail.html'
     context_object_name = 'object'
 
+    def get_cache_parts(self):
+        # the edit button depends on these
+        return super(TillClosureAuditTrailDetailView, self).get_cache_parts() + [
+            self.object.is_deleted, in_editable_period(self.object.close_time)]
+
     def get_object(self):
         pk = self.kwargs.get('pk')
         version = self.kwargs.get('version')
-        return get_object_or_404(TillClosure.audit_trail, identity=pk,
-            version_number=version)
+        queryset = TillClosure.audit_trail.with_deleted_status().select_related(
+            'outlet__business', 'closed_by__user', 'updated_by__user')
+        try:
+            return queryset.get(identity=pk, version_number=version)
+        except TillClosure.DoesNotExist:
+            pass
+        # not stored in full, so rebuild it from its delta
+        current = get_object_or_404(queryset, pk=pk)
+        for tillclosure in current.versions():
+            if tillclosure.version_number == int(version):
+                prefetch_related_objects([tillclosure], 'outlet__business',
+                    'closed_by__user', 'updated_by__user')
+                tillclosure.current_version_exists = \
+                    current.current_version_exists
+                return tillclosure
+        raise Http404('No till closure version found')
 
     def get_context_data(self, *args, **kwargs):
         context = super(TillClosureAuditTrailDetailView, self).get_context_data(
@@ -298,6 +632,16 @@ class TillClosureFormMixin(object):
               'coin_2GBP', 'coin_1GBP', 'coin_50p', 'coin_20p',
               'coin_10p', 'coin_5p', 'coin_2p', 'coin_1p', 'till_float',
               'notes']
+    conflict_message = ('This till closure was changed while you were '
+                        'editing it. Reload the page to see the changes.')
+
+    def form_valid(self, form):
+        # another save of the same closure took the version number first
+        try:
+            return super(TillClosureFormMixin, self).form_valid(form)
+        except IntegrityError:
+            form.add_error(None, self.conflict_message)
+            return self.form_invalid(form)
 
 
 class TillClosureUpdateView(LoginRequiredMixin, PermissionRequiredMixin,
@@ -317,6 +661,8 @@ class TillClosureUpdateView(LoginRequiredMixin, PermissionRequiredMixin,
 
 class TillClosureCreateView(LoginRequiredMixin, TillClosureFormMixin, CreateView):
     permission_required = 'cashup.create_tillclosure_for_outlet'
+    conflict_message = ('This till closure could not be saved. Please try '
+                        'again.')
 
     def check_permissions(self):
         if not self.request.user.has_perm(
@@ -352,3 +698,79 @@ class TillClosureCreateView(LoginRequiredMixin, TillClosureFormMixin, CreateView
         return {
             'till_float': self.get_outlet().default_float
         }
+
+
+class TillClosureBatchCreateView(LoginRequiredMixin, View):
+    """
+    Closes tills for several outlets at once, for point of sale systems.
+    Takes a JSON object whose `closures` list holds the till closure form's
+    fields for each till, with `outlet` given by pk; a missing `close_time`
+    is taken as the current minute, as on the form, and missing denomination
+    counts as 0. Every closure is validated and checked against
+    `cashup.create_tillclosure_for_outlet` before the valid ones are created
+    together in one transaction.
+    Responds with a result for each closure in the order given: its `pk`
+    and `url` if it was created, otherwise its `errors`. If the transaction
+    fails it responds 409 and nothing is saved, so the batch can be retried.
+    """
+    permission_required = 'cashup.create_tillclosure_for_outlet'
+    http_method_names = ['post']
+    raise_exception = True
+
+    def get_batch_limit(self):
+        return getattr(settings, 'CASHUP_CLOSURE_BATCH_LIMIT', 500)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            closures = json.loads(request.body.decode('utf-8'))['closures']
+        except (ValueError, UnicodeDecodeError, TypeError, KeyError):
+            return JsonResponse({'error': 'Expected a JSON object with a '
+                                          '"closures" list'}, status=400)
+        if not isinstance(closures, list) or \
+                not all(isinstance(data, dict) for data in closures):
+            return JsonResponse({'error': '"closures" must be a list of '
+                                          'objects'}, status=400)
+        if len(closures) > self.get_batch_limit():
+            return JsonResponse({'error': 'No more than {} closures may be '
+                'sent at once'.format(self.get_batch_limit())}, status=400)
+
+        personnel = request.user.profile
+        results, valid = [], []
+        for row in closures:
+            # as for bulk_import, counts left out are taken as 0
+            data = dict.fromkeys((f.name for f in DENOMINATION_FIELDS), 0)
+            data['close_time'] = TillClosure._meta.get_field(
+                'close_time').get_default()
+            data.update((k, v) for k, v in row.items() if v not in ('', None))
+            data['closed_by'] = personnel.pk
+            data, errors = TillClosureImportForm.clean_row(data)
+            results.append({'errors': errors} if errors else None)
+            if not errors:
+                valid.append((len(results) - 1, data))
+
+        # one query for the outlets and, through the memoized staff
+        # positions, at most one more for the permission checks
+        outlets = Outlet.objects.filter(
+            pk__in={data['outlet'] for i, data in valid},
+            business_id=personnel.business_id).in_bulk()
+        allowed = {pk for pk, outlet in outlets.items()
+                   if request.user.has_perm(self.permission_required, outlet)}
+        accepted = []
+        for i, data in valid:
+            if data['outlet'] in allowed:
+                accepted.append((i, data))
+            else:
+                results[i] = {'errors': {'outlet': ['Unknown outlet']}}
+
+        if accepted:
+            try:
+                created = TillClosure.objects.create_batch(
+                    [data for i, data in accepted])
+            except IntegrityError:
+                # nothing was saved, so the whole batch can be sent again
+                return JsonResponse({'error': 'The closures could not be '
+                    'saved; please try again'}, status=409)
+            for (i, data), tillclosure in zip(accepted, created):
+                results[i] = {'pk': tillclosure.pk,
+                              'url': tillclosure.get_absolute_url()}
+        return JsonResponse({'created': len(accepted), 'results': results})